@@ -15,10 +15,33 @@ bl_info = {
 
 if "bpy" in locals():
     import importlib
+    # dependencies first, so modules pick up the reloaded names
+    importlib.reload(profiling)
+    importlib.reload(constraints)
+    importlib.reload(bone_map)
+    importlib.reload(bone_space)
+    importlib.reload(decimate)
+    importlib.reload(limbs)
+    importlib.reload(rig_info)
+    importlib.reload(rig_rules)
+    importlib.reload(rig_setup)
+    importlib.reload(validate)
+    importlib.reload(bake)
     importlib.reload(ui)
     importlib.reload(tools)
 
 else:
+    from . import profiling
+    from . import constraints
+    from . import bone_map
+    from . import bone_space
+    from . import decimate
+    from . import limbs
+    from . import rig_info
+    from . import rig_rules
+    from . import rig_setup
+    from . import validate
+    from . import bake
     from . import ui
     from . import tools
 
@@ -0,0 +1,470 @@
+import argparse
+import json
+import sys
+import time
+
+import bpy
+import numpy as np
+
+from .bone_space import (
+    basis_channels, get_bone_table, invalidate_bone_tables,
+    matrices_from_foreach, pose_to_basis, targets_to_basis)
+from .decimate import TOLERANCES, decimate_channel
+from .profiling import phase
+from .rig_setup import CTRL_RIG, DEF_RIG, blend_files
+from .validate import validate_rigs
+
+TOLERANCE_KINDS = ('location', 'rotation', 'scale')
+
+
+def rotation_channel(pose_bone):
+    """ Name of the rotation property used by the bone's rotation mode """
+    if pose_bone.rotation_mode == 'QUATERNION':
+        return 'rotation_quaternion'
+    if pose_bone.rotation_mode == 'AXIS_ANGLE':
+        return 'rotation_axis_angle'
+    return 'rotation_euler'
+
+
+def channel_path(bone_name, prop):
+    """ fcurve data path of a pose bone property or custom property """
+    path = 'pose.bones["{}"]'.format(bone_name)
+    return path + prop if prop.startswith('[') else '{}.{}'.format(path, prop)
+
+
+def split_channel_path(data_path):
+    """ (bone name, property) of a channel_path(), None if not a bone's """
+    if not data_path.startswith('pose.bones["'):
+        return None
+    name, _, prop = data_path[len('pose.bones["'):].partition('"]')
+    return name, prop[1:] if prop.startswith('.') else prop
+
+
+# FCurve settings kept when empty_fcurve() replaces one
+FCURVE_SETTINGS = (
+    'extrapolation', 'color_mode', 'color', 'hide', 'lock', 'mute', 'select')
+
+
+def empty_fcurve(action, fcurve):
+    """
+    Replace fcurve with a new one of the same channel, group and settings
+    but no keys: one call instead of removing its keys one by one
+    """
+    settings = {attr: getattr(fcurve, attr) for attr in FCURVE_SETTINGS}
+    settings['color'] = tuple(settings['color'])
+    data_path, index = fcurve.data_path, fcurve.array_index
+    group = fcurve.group.name if fcurve.group else ''
+    action.fcurves.remove(fcurve)
+    fcurve = action.fcurves.new(data_path, index=index, action_group=group)
+    for attr, value in settings.items():
+        setattr(fcurve, attr, value)
+    return fcurve
+
+
+def set_fcurve_keys(
+        action, data_path, index, frames, values, group='',
+        interpolation=None):
+    """
+    Key values at frames on one fcurve with a single foreach_set. Keys in
+    the frame range are replaced; the keys outside it, the fcurve's
+    modifiers and settings are left as they are. group is used for a new
+    fcurve only.
+    """
+    fcurve = action.fcurves.find(data_path, index)
+    if not len(frames):
+        return fcurve
+    if fcurve is None:
+        fcurve = action.fcurves.new(data_path, index=index, action_group=group)
+    points = fcurve.keyframe_points
+    old_frames = fcurve_keys(fcurve)[:, 0]
+    inside = (old_frames >= np.min(frames)) & (old_frames <= np.max(frames))
+    if len(points) and inside.all() and not fcurve.modifiers:
+        # every key is replaced, e.g. by decimation or a rebake
+        fcurve = empty_fcurve(action, fcurve)
+        points = fcurve.keyframe_points
+    else:
+        for i in reversed(np.flatnonzero(inside).tolist()):
+            points.remove(points[i], fast=True)
+    kept = len(points)
+    points.add(len(frames))
+    keys = np.empty(len(points) * 2, dtype=np.float32)
+    points.foreach_get('co', keys)
+    keys = keys.reshape(-1, 2)
+    keys[kept:, 0] = frames
+    keys[kept:, 1] = values
+    points.foreach_set('co', keys.ravel())
+    if interpolation:
+        for point in points[kept:]:
+            point.interpolation = interpolation
+    fcurve.update()
+    return fcurve
+
+
+def get_action(ob):
+    """ ob's active action, created if it has none """
+    if not ob.animation_data:
+        ob.animation_data_create()
+    if not ob.animation_data.action:
+        ob.animation_data.action = bpy.data.actions.new(
+            '{}Action'.format(ob.name))
+    return ob.animation_data.action
+
+
+def key_channels(ob, frames, values, action=None):
+    """
+    Write {(bone name, property): (frames, components) array} values as
+    keys on ob's action
+    """
+    if action is None:
+        action = get_action(ob)
+    frames = np.asarray(frames, dtype=np.float32)
+    for (name, prop), rows in values.items():
+        data_path = channel_path(name, prop)
+        for index in range(rows.shape[1]):
+            set_fcurve_keys(
+                action, data_path, index, frames, rows[:, index], name)
+    return action
+
+
+class only_layers:
+    """ Context manager showing only the scene layers objects are on """
+
+    def __init__(self, scene, objects):
+        self.scene = scene
+        self.layers = [
+            any(ob.layers[i] for ob in objects) for i in range(20)]
+
+    def __enter__(self):
+        self.saved = list(self.scene.layers)
+        if any(self.layers):
+            self.scene.layers = self.layers
+
+    def __exit__(self, *args):
+        self.scene.layers = self.saved
+
+
+def read_pose(ob, table, buffer=None):
+    """ (bones, 4, 4) current pose matrices of ob in table bone order """
+    if buffer is None:
+        buffer = np.empty(len(table.names) * 16, dtype=np.float32)
+    ob.pose.bones.foreach_get('matrix', buffer)
+    pose = np.empty((len(table.names), 4, 4))
+    pose[table.pose_order] = matrices_from_foreach(buffer)
+    return pose
+
+
+def record_pose_matrices(scene, ob, frames, table):
+    """
+    (frames, bones, 4, 4) evaluated pose matrices of ob in table bone order,
+    one foreach_get per frame
+    """
+    buffer = np.empty(len(table.names) * 16, dtype=np.float32)
+    matrices = np.empty((len(frames), len(table.names), 4, 4))
+    current = scene.frame_current
+    for row, frame in enumerate(frames):
+        scene.frame_set(frame)
+        matrices[row] = read_pose(ob, table, buffer)
+    scene.frame_set(current)
+    return matrices
+
+
+def basis_values(ob, table, basis, channels):
+    """
+    {(bone name, property): (frames, components) array} values from
+    (frames, bones, 4, 4) matrix_basis, for channels {bone name: subset of
+    ('location', 'rotation', 'scale')}
+    """
+    pose_bones = ob.pose.bones
+    names = list(channels)
+    modes = [pose_bones[name].rotation_mode for name in names]
+    decomposed = basis_channels(
+        basis[:, [table.index[name] for name in names]], modes)
+    values = {}
+    for column, name in enumerate(names):
+        for channel in channels[name]:
+            prop, rows = channel, decomposed[channel][:, column]
+            if channel == 'rotation':
+                prop = rotation_channel(pose_bones[name])
+                if prop == 'rotation_euler':
+                    rows = rows[:, :3]
+            values[name, prop] = rows
+    return values
+
+
+def target_values(ob, table, pose, targets):
+    """
+    basis_values() of the bones in targets ({bone name: (pose space
+    matrices, channel names)}) moved onto their matrices in the
+    (frames, bones, 4, 4) pose, all solved in one batch
+    """
+    basis = targets_to_basis(
+        table, pose,
+        {name: matrices for name, (matrices, _) in targets.items()})
+    return basis_values(ob, table, basis, {
+        name: channels for name, (_, channels) in targets.items()})
+
+
+def set_pose_channels(ob, values):
+    """
+    Set the first row of basis_values() on ob's pose bones, keeping euler
+    rotations close to their current values
+    """
+    pose_bones = ob.pose.bones
+    for (name, prop), rows in values.items():
+        value = rows[0]
+        if prop == 'rotation_euler':
+            current = np.array(pose_bones[name].rotation_euler)
+            value = current + (value - current + np.pi) % (2 * np.pi) - np.pi
+        setattr(pose_bones[name], prop, value)
+
+
+def bake_deform_rig(scene, deform, frames, action=None, objects=()):
+    """
+    Key the constraint driven pose of deform over frames as plain location,
+    rotation and scale channels on action (default a new one). Only the
+    scene layers of deform and objects (e.g. the control rig) are evaluated.
+    """
+    table = get_bone_table(deform)
+    frames = np.asarray(frames)
+    if not deform.animation_data:
+        deform.animation_data_create()
+    deform.animation_data.action = None
+    bones = len(table.names)
+    # the old action's last values would sit under every constraint result
+    deform.pose.bones.foreach_set('matrix_basis', np.tile(
+        np.eye(4, dtype=np.float32), (len(deform.pose.bones), 1, 1)).ravel())
+    with phase('bake.record', frames=len(frames), bones=bones):
+        with only_layers(scene, [deform] + list(objects)):
+            pose = record_pose_matrices(scene, deform, frames, table)
+    with phase('bake.convert', frames=len(frames), bones=bones):
+        values = basis_values(deform, table, pose_to_basis(table, pose), {
+            name: ('location', 'rotation', 'scale') for name in table.names})
+    if action is None:
+        action = bpy.data.actions.new('{}Bake'.format(deform.name))
+    with phase('bake.write', channels=len(values)):
+        key_channels(deform, frames, values, action)
+    deform.animation_data.action = action
+    return action
+
+
+def fcurve_keys(fcurve):
+    """ (keys, 2) array of an fcurve's (frame, value) points """
+    points = fcurve.keyframe_points
+    keys = np.empty(len(points) * 2, dtype=np.float32)
+    points.foreach_get('co', keys)
+    return keys.reshape(-1, 2)
+
+
+def decimate_action(action, tolerances=None):
+    """
+    Drop keys of action's pose bone channels that linear interpolation
+    reproduces within tolerances (see decimate.TOLERANCES). All components
+    of a property keep the same frames. Returns {bone name: {'keys',
+    'kept', 'error': {property: max error}}}.
+    """
+    with phase('decimate', fcurves=len(action.fcurves)):
+        return _decimate_action(action, tolerances)
+
+
+def _decimate_action(action, tolerances):
+    channels = {}
+    for fcurve in action.fcurves:
+        channel = split_channel_path(fcurve.data_path)
+        if channel:
+            channels.setdefault(channel, []).append(fcurve)
+    report = {}
+    for (name, prop), fcurves in channels.items():
+        fcurves.sort(key=lambda fcurve: fcurve.array_index)
+        keys = [fcurve_keys(fcurve) for fcurve in fcurves]
+        frames = keys[0][:, 0]
+        if any(len(k) != len(frames) or (k[:, 0] != frames).any()
+               for k in keys):
+            continue
+        values = np.stack([k[:, 1] for k in keys], axis=1)
+        keep, error = decimate_channel(frames, values, prop, tolerances)
+        bone = report.setdefault(name, {'keys': 0, 'kept': 0, 'error': {}})
+        bone['keys'] += values.size
+        bone['kept'] += int(keep.sum()) * len(fcurves)
+        bone['error'][prop] = error
+        for fcurve, column in zip(list(fcurves), values.T):
+            group = fcurve.group.name if fcurve.group else name
+            set_fcurve_keys(
+                action, fcurve.data_path, fcurve.array_index, frames[keep],
+                column[keep], group, 'LINEAR')
+    return report
+
+
+def decimate_summary(report):
+    """ (keys, kept keys, compression ratio) over a decimate_action() """
+    keys = sum(bone['keys'] for bone in report.values())
+    kept = sum(bone['kept'] for bone in report.values())
+    return keys, kept, keys / kept if kept else 1.0
+
+
+def decimate_lines(report):
+    """ One line per bone: kept keys, compression ratio and max errors """
+    lines = []
+    for name, bone in sorted(report.items()):
+        errors = ', '.join(
+            '{} {:.5f}'.format(prop, error)
+            for prop, error in sorted(bone['error'].items()))
+        lines.append('{}: {}/{} keys ({:.1f}x), max error {}'.format(
+            name, bone['kept'], bone['keys'],
+            bone['keys'] / max(bone['kept'], 1), errors))
+    return lines
+
+
+def mute_constraints(ob, mute=True):
+    """ Mute (or unmute) every pose bone constraint of ob """
+    for pose_bone in ob.pose.bones:
+        for constraint in pose_bone.constraints:
+            constraint.mute = mute
+
+
+def bake_actions(
+        scene, ctrl, deform, actions, suffix='_unity', tolerances=None):
+    """
+    Bake deform for each control rig action into '<action><suffix>',
+    decimated with tolerances if given; returns (action name, frame
+    count, seconds, compression ratio, decimate_action() report or None)
+    for each
+    """
+    for ob in (ctrl, deform):
+        if not ob.animation_data:
+            ob.animation_data_create()
+    original = ctrl.animation_data.action
+    original_deform = deform.animation_data.action
+    report = []
+    try:
+        for action in actions:
+            start = time.perf_counter()
+            ctrl.animation_data.action = action
+            first, last = (int(round(f)) for f in action.frame_range)
+            frames = np.arange(first, last + 1)
+            name = action.name + suffix
+            baked = bpy.data.actions.get(name) or bpy.data.actions.new(name)
+            baked.use_fake_user = True
+            bake_deform_rig(scene, deform, frames, baked, [ctrl])
+            ratio, decimation = 1.0, None
+            if tolerances is not None:
+                decimation = decimate_action(baked, tolerances)
+                ratio = decimate_summary(decimation)[2]
+            report.append((
+                action.name, len(frames), time.perf_counter() - start,
+                ratio, decimation))
+    finally:
+        # an action left without users is not saved
+        ctrl.animation_data.action = original
+        deform.animation_data.action = original_deform
+    return report
+
+
+def control_actions(ctrl, deform=None, suffix='_unity'):
+    """
+    Actions animating ctrl: every pose bone they key exists in ctrl. Ones
+    baked with suffix, deform's active action and those Blender named
+    after deform (e.g. 'rig_defAction.001') are left out.
+    """
+    pose_bones = ctrl.pose.bones
+    skip, prefix = set(), None
+    if deform is not None:
+        prefix = deform.name
+        if deform.animation_data and deform.animation_data.action:
+            skip.add(deform.animation_data.action.name)
+    actions = []
+    for action in bpy.data.actions:
+        name = action.name
+        if name.endswith(suffix) or name in skip or (
+                prefix and name.startswith(prefix) and
+                not name.startswith(ctrl.name)):
+            continue
+        channels = [
+            split_channel_path(fcurve.data_path)
+            for fcurve in action.fcurves]
+        bones = {channel[0] for channel in channels if channel}
+        if bones and all(bone in pose_bones for bone in bones):
+            actions.append(action)
+    return actions
+
+
+def bake_file(
+        filepath, ctrl_name, def_name, suffix, mute, save=True,
+        tolerances=None):
+    """ Open a .blend and bake all its control actions; returns a report """
+    report = {
+        'file': filepath, 'error': None, 'actions': [], 'validation': []}
+    start = time.perf_counter()
+    try:
+        bpy.ops.wm.open_mainfile(filepath=filepath)
+        # the new file's armatures can reuse the previous file's pointers
+        invalidate_bone_tables()
+        ctrl = bpy.data.objects[ctrl_name]
+        deform = bpy.data.objects[def_name]
+        with phase('validate'):
+            report['validation'] = [
+                rig_report.as_dict() for rig_report in validate_rigs(
+                    bpy.context.scene.objects, {'ctrl': ctrl, 'def': deform})]
+        report['actions'] = bake_actions(
+            bpy.context.scene, ctrl, deform,
+            control_actions(ctrl, deform, suffix), suffix, tolerances)
+        if mute:
+            mute_constraints(deform)
+        if save:
+            bpy.ops.wm.save_mainfile()
+    except Exception as error:
+        report['error'] = '{}: {}'.format(type(error).__name__, error)
+    report['total'] = time.perf_counter() - start
+    return report
+
+
+def main(argv=None):
+    """ Command line entry, arguments come after blender's '--' """
+    if argv is None:
+        argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    parser = argparse.ArgumentParser(
+        prog='rig_bake-unity.py',
+        description='Bake Kognito deform rig actions for Unity export')
+    parser.add_argument('paths', nargs='+', help='.blend files or folders')
+    parser.add_argument('--ctrl', default=CTRL_RIG, help='control rig name')
+    parser.add_argument('--def', dest='deform', default=DEF_RIG,
+                        help='deform rig name')
+    parser.add_argument('--suffix', default='_unity',
+                        help='baked action name suffix')
+    parser.add_argument('--mute', action='store_true',
+                        help='mute the deform rig constraints afterwards')
+    parser.add_argument('--decimate', action='store_true',
+                        help='drop keys linear interpolation reproduces')
+    parser.add_argument('--tolerance', type=float, nargs=3,
+                        metavar=('LOC', 'ROT', 'SCALE'),
+                        default=[TOLERANCES[kind] for kind in TOLERANCE_KINDS],
+                        help='decimation tolerances, rotation in radians')
+    parser.add_argument('--no-save', dest='save', action='store_false',
+                        help='do not save the files')
+    parser.add_argument('--report', help='write the timings as JSON here')
+    args = parser.parse_args(argv)
+    tolerances = None
+    if args.decimate:
+        tolerances = dict(zip(TOLERANCE_KINDS, args.tolerance))
+    reports = []
+    for filepath in blend_files(args.paths):
+        report = bake_file(
+            filepath, args.ctrl, args.deform, args.suffix, args.mute,
+            args.save, tolerances)
+        reports.append(report)
+        print('{:8.3f}s {} {} actions {}'.format(
+            report['total'], filepath, len(report['actions']),
+            report['error'] or 'ok'))
+        for rig_report in report['validation']:
+            for issue in rig_report['issues']:
+                print('    {} {} {}: {} {}: {}'.format(
+                    rig_report['rig'], issue['severity'], issue['check'],
+                    issue['owner'], issue['item'], issue['message']))
+        for name, frames, seconds, ratio, decimation in report['actions']:
+            print('    {:8.3f}s {} {} frames {:.1f}x'.format(
+                seconds, name, frames, ratio))
+            for line in decimate_lines(decimation or {}):
+                print('        ' + line)
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(reports, report_file, indent=2)
+    return reports
@@ -0,0 +1,126 @@
+"""
+Bone name mapping between rigs that use different naming schemes.
+
+Name rules are plain dicts (or JSON files) with any of:
+
+    strip_prefixes: prefixes ignored when matching, e.g. ["ORG-", "DEF-"]
+    sides: side suffixes and what they mean, e.g. {"_l": ".L"}
+    ignore_case: match names case insensitively
+    table: explicit {source name: target name} pairs, checked first
+"""
+
+import json
+
+# Rules for the naming schemes our vendor rigs commonly use
+VENDOR_RULES = {
+    'strip_prefixes': ['ORG-', 'DEF-', 'MCH-', 'GEO_'],
+    'sides': {
+        '.L': '.L', '.R': '.R', '.l': '.L', '.r': '.R',
+        '_L': '.L', '_R': '.R', '_l': '.L', '_r': '.R',
+        '-L': '.L', '-R': '.R', 'Left': '.L', 'Right': '.R'},
+    }
+
+# face_link: deform face bones are the control bones prefixed with GEO_
+FACE_RULES = {'strip_prefixes': ['GEO_']}
+
+
+def load_name_rules(filepath):
+    with open(filepath) as rules_file:
+        return json.load(rules_file)
+
+
+class NameKey:
+    """ Reduces bone names to a comparable key under a set of name rules """
+
+    def __init__(self, rules):
+        self.prefixes = sorted(
+            rules.get('strip_prefixes', ()), key=len, reverse=True)
+        self.sides = sorted(
+            rules.get('sides', {}).items(), key=lambda s: len(s[0]),
+            reverse=True)
+        self.ignore_case = rules.get('ignore_case', False)
+
+    def __call__(self, name):
+        for prefix in self.prefixes:
+            if name.startswith(prefix):
+                name = name[len(prefix):]
+                break
+        for suffix, side in self.sides:
+            if name.endswith(suffix):
+                name = name[:-len(suffix)] + side
+                break
+        return name.lower() if self.ignore_case else name
+
+
+class BoneMap:
+    """
+    Source -> target bone names for one pair of rigs, built once so every
+    lookup is a dict access; names with no match are kept in unmapped.
+    Each target takes one source: table and exact name matches first, then
+    the first source whose key matches; the others go to collisions as
+    (source, target) pairs.
+    """
+
+    def __init__(self, source_names, target_names, rules=None):
+        rules = rules or {}
+        key = NameKey(rules)
+        targets = set(target_names)
+        by_key = {}
+        self.ambiguous = []
+        for name in target_names:
+            name_key = key(name)
+            if name_key in by_key:
+                self.ambiguous.append(name)
+            else:
+                by_key[name_key] = name
+        table = rules.get('table', {})
+        self.mapping = {}
+        self.unmapped = []
+        self.collisions = []
+        claimed = set()
+        by_name = []
+        for name in source_names:
+            target = table.get(name)
+            if target not in targets:
+                target = name if name in targets else None
+            by_name.append((name, target))
+        for name, target in by_name:
+            if target is not None:
+                self._claim(name, target, claimed)
+        for name, target in by_name:
+            if target is None:
+                target = by_key.get(key(name))
+                if target is None:
+                    self.unmapped.append(name)
+                else:
+                    self._claim(name, target, claimed)
+
+    def _claim(self, name, target, claimed):
+        if target in claimed:
+            self.collisions.append((name, target))
+        else:
+            claimed.add(target)
+            self.mapping[name] = target
+
+    def get(self, name, default=None):
+        return self.mapping.get(name, default)
+
+    def map_names(self, names):
+        """ Target name for each of names, None where unmapped """
+        mapping = self.mapping
+        return [mapping.get(name) for name in names]
+
+    def report(self):
+        """ One line summary listing the unmapped and colliding bones """
+        text = "{} bones mapped, {} unmapped".format(
+            len(self.mapping), len(self.unmapped))
+        if self.unmapped:
+            text += ": " + ", ".join(self.unmapped)
+        if self.collisions:
+            text += "; {} skipped, target already mapped: {}".format(
+                len(self.collisions), ", ".join(
+                    "{} -> {}".format(name, target)
+                    for name, target in self.collisions))
+        if self.ambiguous:
+            text += "; ambiguous targets: " + ", ".join(self.ambiguous)
+        return text
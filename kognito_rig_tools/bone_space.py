@@ -0,0 +1,287 @@
+"""
+Array versions of Blender's pose space <-> bone channel conversions, for
+converting many bones over many frames at once. Matrices use NumPy's row
+major layout (m[..., row, column]), translations live in m[..., :3, 3].
+"""
+
+import numpy as np
+
+# BoneTable per armature data pointer, see get_bone_table()
+_tables = {}
+
+# axis order and parity of Blender's euler rotation modes
+EULER_ORDERS = {
+    'XYZ': ((0, 1, 2), False), 'XZY': ((0, 2, 1), True),
+    'YXZ': ((1, 0, 2), True), 'YZX': ((1, 2, 0), False),
+    'ZXY': ((2, 0, 1), False), 'ZYX': ((2, 1, 0), True),
+    }
+
+
+def matrices_from_foreach(values):
+    """ (n, 4, 4) matrices from a flat foreach_get of a matrix property """
+    return np.asarray(values).reshape(-1, 4, 4).transpose(0, 2, 1)
+
+
+class BoneTable:
+    """
+    Rest data of an armature's bones in bone order: rest matrices, parent
+    indices, offsets from the parent rest, and inheritance flags
+    """
+
+    def __init__(self, armature):
+        bones = armature.data.bones
+        count = len(bones)
+        self.names = [bone.name for bone in bones]
+        index = self.index = {name: i for i, name in enumerate(self.names)}
+        self.pose_order = np.array(
+            [index[bone.name] for bone in armature.pose.bones],
+            dtype=np.int64)
+        self.parents = np.array([
+            index[bone.parent.name] if bone.parent else -1 for bone in bones],
+            dtype=np.int64)
+        matrices = np.empty(count * 16, dtype=np.float64)
+        bones.foreach_get('matrix_local', matrices)
+        self.rest = matrices_from_foreach(matrices)
+        flags = {}
+        for flag in (
+                'use_inherit_rotation', 'use_inherit_scale',
+                'use_local_location'):
+            values = np.empty(count, dtype=bool)
+            bones.foreach_get(flag, values)
+            flags[flag] = values
+        self.inherit_rotation = flags['use_inherit_rotation']
+        self.inherit_scale = flags['use_inherit_scale']
+        self.local_location = flags['use_local_location']
+        self.has_parent = self.parents >= 0
+        parent_rest = self.rest[np.where(self.has_parent, self.parents, 0)]
+        self.offset = np.where(
+            self.has_parent[:, None, None],
+            np.linalg.inv(parent_rest) @ self.rest, self.rest)
+        self.rest_inverse = np.linalg.inv(self.rest)
+
+
+def get_bone_table(armature):
+    """
+    BoneTable of armature, cached per armature data until
+    invalidate_bone_tables() drops it or the bone count changes
+    """
+    key = armature.data.as_pointer()
+    cached = _tables.get(key)
+    if cached is None or len(cached[1].names) != len(armature.data.bones):
+        cached = _tables[key] = (armature.data, BoneTable(armature))
+    return cached[1]
+
+
+def invalidate_bone_tables(updated=None):
+    """ Drop the cached tables whose armature data updated() is true for """
+    if updated is None:
+        _tables.clear()
+        return
+    for key, (data, table) in list(_tables.items()):
+        try:
+            stale = updated(data)
+        except ReferenceError:
+            stale = True
+        if stale:
+            del _tables[key]
+
+
+def pose_spaces(table, pose):
+    """
+    Rotation/scale and location spaces of every bone for pose matrices of
+    shape (..., bones, 4, 4); BKE_pchan_to_pose_mat over arrays
+    """
+    parent = pose[..., np.where(table.has_parent, table.parents, 0), :, :]
+    offset = table.offset
+    rotscale = parent @ offset
+
+    no_scale = table.has_parent & ~table.inherit_scale
+    if no_scale.any():
+        normalized = parent / np.linalg.norm(
+            parent[..., :3, :], axis=-2)[..., None, :].clip(1e-12)
+        normalized[..., :3, 3] = parent[..., :3, 3]
+        normalized[..., 3, :] = (0.0, 0.0, 0.0, 1.0)
+        rotscale = np.where(
+            no_scale[:, None, None], normalized @ offset, rotscale)
+    hinge = table.has_parent & ~table.inherit_rotation
+    if hinge.any():
+        # parent pose scale applied over the rest matrix: scale @ rest
+        hinged = np.broadcast_to(table.rest, rotscale.shape).copy()
+        parent_scale = np.linalg.norm(parent[..., :3, :3], axis=-2)
+        hinged[..., :3, :] *= np.where(
+            table.inherit_scale[:, None], parent_scale, 1.0)[..., :, None]
+        rotscale = np.where(hinge[:, None, None], hinged, rotscale)
+    rotscale = np.where(
+        table.has_parent[:, None, None], rotscale, table.rest)
+
+    location = np.where(
+        (hinge | no_scale)[:, None, None], parent @ offset, rotscale)
+    no_local = ~table.local_location
+    if no_local.any():
+        fixed = np.zeros(rotscale.shape)
+        fixed[..., :3, :3] = np.where(
+            table.has_parent[:, None, None], parent[..., :3, :3], np.eye(3))
+        fixed[..., :3, 3] = np.where(
+            table.has_parent[:, None], (parent @ offset)[..., :3, 3],
+            table.rest[:, :3, 3])
+        fixed[..., 3, 3] = 1.0
+        location = np.where(no_local[:, None, None], fixed, location)
+    return rotscale, location
+
+
+def pose_to_basis(table, pose):
+    """
+    matrix_basis of every bone from pose space matrices (..., bones, 4, 4);
+    BKE_armature_mat_pose_to_bone over arrays
+    """
+    rotscale, location = pose_spaces(table, pose)
+    basis = np.linalg.inv(rotscale) @ pose
+    point = np.linalg.inv(location) @ pose[..., :, 3:]
+    basis[..., :3, 3] = point[..., :3, 0]
+    return basis
+
+
+def targets_to_basis(table, pose, targets):
+    """
+    pose_to_basis() after moving bones to targets ({bone name: pose space
+    matrices}), so targets parented to each other are solved together
+    """
+    pose = pose.copy()
+    for name, matrices in targets.items():
+        pose[..., table.index[name], :, :] = matrices
+    return pose_to_basis(table, pose)
+
+
+def matrix_to_scale(matrices):
+    """ Scale of (..., 3+, 3+) matrices, negative if the basis is flipped """
+    scale = np.linalg.norm(matrices[..., :3, :3], axis=-2)
+    flipped = np.linalg.det(matrices[..., :3, :3]) < 0.0
+    return np.where(flipped[..., None], -scale, scale)
+
+
+def normalized_rotation(matrices):
+    """
+    Rotation part of (..., 3+, 3+) matrices with unit axes, negated for
+    flipped matrices to pair with matrix_to_scale() as in
+    mat4_to_loc_rot_size
+    """
+    m = matrices[..., :3, :3]
+    m = m / np.linalg.norm(m, axis=-2)[..., None, :].clip(1e-12)
+    flipped = np.linalg.det(m) < 0.0
+    return np.where(flipped[..., None, None], -m, m)
+
+
+def matrix_to_quaternion(matrices):
+    """ (w, x, y, z) quaternions of the rotation of (..., 3+, 3+) matrices """
+    m = normalized_rotation(matrices)
+    m00, m11, m22 = m[..., 0, 0], m[..., 1, 1], m[..., 2, 2]
+    quats = np.empty(m.shape[:-2] + (4,))
+    trace = 0.25 * (1.0 + m00 + m11 + m22)
+    cases = [
+        (trace > 1e-4, lambda: 4.0 * np.sqrt(trace.clip(1e-12)),
+         lambda s: (0.25 * s, (m[..., 2, 1] - m[..., 1, 2]) / s,
+                    (m[..., 0, 2] - m[..., 2, 0]) / s,
+                    (m[..., 1, 0] - m[..., 0, 1]) / s)),
+        ((m00 > m11) & (m00 > m22),
+         lambda: 2.0 * np.sqrt((1.0 + m00 - m11 - m22).clip(1e-12)),
+         lambda s: ((m[..., 2, 1] - m[..., 1, 2]) / s, 0.25 * s,
+                    (m[..., 0, 1] + m[..., 1, 0]) / s,
+                    (m[..., 0, 2] + m[..., 2, 0]) / s)),
+        (m11 > m22,
+         lambda: 2.0 * np.sqrt((1.0 + m11 - m00 - m22).clip(1e-12)),
+         lambda s: ((m[..., 0, 2] - m[..., 2, 0]) / s,
+                    (m[..., 0, 1] + m[..., 1, 0]) / s, 0.25 * s,
+                    (m[..., 1, 2] + m[..., 2, 1]) / s)),
+        (np.ones(m00.shape, dtype=bool),
+         lambda: 2.0 * np.sqrt((1.0 + m22 - m00 - m11).clip(1e-12)),
+         lambda s: ((m[..., 1, 0] - m[..., 0, 1]) / s,
+                    (m[..., 0, 2] + m[..., 2, 0]) / s,
+                    (m[..., 1, 2] + m[..., 2, 1]) / s, 0.25 * s)),
+        ]
+    done = np.zeros(m00.shape, dtype=bool)
+    for condition, scale, components in cases:
+        use = condition & ~done
+        done |= use
+        if use.any():
+            quats[use] = np.stack(components(scale()), axis=-1)[use]
+    quats /= np.linalg.norm(quats, axis=-1)[..., None]
+    return quats
+
+
+def continuous_quaternions(quats, axis=0):
+    """ Flip quaternion signs along axis (frames) so neighbours agree """
+    quats = np.moveaxis(quats, axis, 0).copy()
+    dots = (quats[1:] * quats[:-1]).sum(axis=-1)
+    signs = np.cumprod(np.where(dots < 0.0, -1.0, 1.0), axis=0)
+    quats[1:] *= signs[..., None]
+    return np.moveaxis(quats, 0, axis)
+
+
+def quaternion_to_axis_angle(quats):
+    """ (angle, x, y, z) as stored in rotation_axis_angle """
+    w = quats[..., 0].clip(-1.0, 1.0)
+    angle = 2.0 * np.arccos(w)
+    sin = np.sqrt(1.0 - w * w)
+    axis = np.where(
+        sin[..., None] > 1e-8, quats[..., 1:] / sin.clip(1e-8)[..., None],
+        (0.0, 1.0, 0.0))
+    return np.concatenate([angle[..., None], axis], axis=-1)
+
+
+def matrix_to_euler(matrices, order='XYZ'):
+    """ Euler angles in rotation order of (..., 3+, 3+) matrices """
+    (i, j, k), parity = EULER_ORDERS[order]
+    m = normalized_rotation(matrices)
+    # Blender indexes matrices column first: mat[a][b] is m[..., b, a]
+    cy = np.hypot(m[..., i, i], m[..., j, i])
+    regular = cy > 16.0 * np.finfo(np.float32).eps
+    first = np.empty(m.shape[:-2] + (3,))
+    second = np.empty(m.shape[:-2] + (3,))
+    first[..., i] = np.where(
+        regular, np.arctan2(m[..., k, j], m[..., k, k]),
+        np.arctan2(-m[..., j, k], m[..., j, j]))
+    first[..., j] = np.arctan2(-m[..., k, i], cy)
+    first[..., k] = np.where(
+        regular, np.arctan2(m[..., j, i], m[..., i, i]), 0.0)
+    second[..., i] = np.arctan2(-m[..., k, j], -m[..., k, k])
+    second[..., j] = np.arctan2(-m[..., k, i], -cy)
+    second[..., k] = np.arctan2(-m[..., j, i], -m[..., i, i])
+    second = np.where(regular[..., None], second, first)
+    if parity:
+        first, second = -first, -second
+    use_first = np.abs(first).sum(axis=-1) <= np.abs(second).sum(axis=-1)
+    return np.where(use_first[..., None], first, second)
+
+
+def basis_channels(basis, rotation_modes):
+    """
+    {'location', 'rotation', 'scale': arrays} from matrix_basis of shape
+    (frames, bones, 4, 4); rotation holds 4 values per bone (w, x, y, z or
+    angle, x, y, z), or euler angles in the first 3 for euler modes
+    """
+    quats = continuous_quaternions(matrix_to_quaternion(basis))
+    rotation = quats.copy()
+    modes = np.array(rotation_modes)
+    axis_angle = modes == 'AXIS_ANGLE'
+    if axis_angle.any():
+        rotation[:, axis_angle] = quaternion_to_axis_angle(
+            quats[:, axis_angle])
+    for order in EULER_ORDERS:
+        use = modes == order
+        if use.any():
+            euler = np.unwrap(matrix_to_euler(basis[:, use], order), axis=0)
+            rotation[:, use, :3] = euler
+            rotation[:, use, 3] = 0.0
+    return {
+        'location': basis[..., :3, 3],
+        'rotation': rotation,
+        'scale': matrix_to_scale(basis),
+        }
+
+
+def quaternion_angle(a, b):
+    """ Rotation angle between (..., 4) quaternions a and b """
+    a = a / np.linalg.norm(a, axis=-1)[..., None].clip(1e-12)
+    b = b / np.linalg.norm(b, axis=-1)[..., None].clip(1e-12)
+    dot = np.abs((a * b).sum(axis=-1)).clip(0.0, 1.0)
+    return 2.0 * np.arccos(dot)
@@ -0,0 +1,51 @@
+class ConstraintIndex:
+    """
+    Pose bone constraints of an armature indexed by (bone name, type) and
+    (bone name, type, constraint name); build once per operation and add
+    constraints through it to keep it current
+    """
+
+    def __init__(self, ob):
+        self.by_type = {}
+        self.by_name = {}
+        for bone in ob.pose.bones:
+            for con in bone.constraints:
+                self._store(bone.name, con)
+
+    def _store(self, bone_name, con):
+        self.by_type.setdefault((bone_name, con.type), []).append(con)
+        self.by_name[bone_name, con.type, con.name] = con
+
+    def find_all(self, bone, constraint_type):
+        """ All constraints of constraint_type on bone, in stack order """
+        return self.by_type.get((bone.name, constraint_type), [])
+
+    def find(self, bone, constraint_type, name=None):
+        """ First constraint of constraint_type on bone, or the named one """
+        if name is not None:
+            return self.by_name.get((bone.name, constraint_type, name))
+        cons = self.by_type.get((bone.name, constraint_type))
+        return cons[0] if cons else None
+
+    def add(self, bone, constraint_type, name=None):
+        con = bone.constraints.new(type=constraint_type)
+        if name is not None:
+            con.name = name
+        self._store(bone.name, con)
+        return con
+
+    def find_or_add(self, bone, constraint_type, name=None):
+        con = self.find(bone, constraint_type, name)
+        if con is None:
+            con = self.add(bone, constraint_type, name)
+        return con
+
+
+def find_or_add_constraint(bone, constraint, index=None):
+    """ First constraint of exactly type constraint on bone, added if none """
+    if index is not None:
+        return index.find_or_add(bone, constraint)
+    for con in bone.constraints:
+        if con.type == constraint:
+            return con
+    return bone.constraints.new(type=constraint)
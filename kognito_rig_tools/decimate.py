@@ -0,0 +1,81 @@
+"""
+Keyframe reduction for baked curves. Keys are dropped while linear
+interpolation between the kept ones stays within a tolerance, using
+Ramer-Douglas-Peucker with every open segment split in the same pass.
+"""
+
+import numpy as np
+
+from .bone_space import quaternion_angle
+
+# Default tolerances: scene units for location, radians for rotation
+TOLERANCES = {'location': 0.001, 'rotation': 0.001, 'scale': 0.001}
+
+
+def component_error(values, interpolated):
+    """ Largest per component difference of each key """
+    return np.abs(values - interpolated).max(axis=-1)
+
+
+def quaternion_error(values, interpolated):
+    """ Angle between the keyed and the interpolated (normalized) rotation """
+    return quaternion_angle(values, interpolated)
+
+
+def interpolate_kept(frames, values, keep):
+    """ values linearly interpolated between the kept keys """
+    positions = np.arange(len(frames))
+    previous = np.maximum.accumulate(np.where(keep, positions, 0))
+    following = np.minimum.accumulate(
+        np.where(keep, positions, len(frames) - 1)[::-1])[::-1]
+    span = frames[following] - frames[previous]
+    t = np.where(
+        span > 0, (frames - frames[previous]) / np.where(span > 0, span, 1),
+        0.0)
+    interpolated = values[previous] + (
+        values[following] - values[previous]) * t[:, None]
+    return interpolated, previous
+
+
+def decimate_keys(frames, values, tolerance, error=component_error):
+    """
+    Keep mask for keys at frames with (frames, components) values, so
+    the curves between kept keys stay within tolerance; returns
+    (keep, max error)
+    """
+    frames = np.asarray(frames, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    keep = np.zeros(len(frames), dtype=bool)
+    if not len(frames):
+        return keep, 0.0
+    keep[[0, -1]] = True
+    while True:
+        interpolated, segments = interpolate_kept(frames, values, keep)
+        errors = error(values, interpolated)
+        errors[keep] = 0.0
+        over = np.flatnonzero(errors > tolerance)
+        if not len(over):
+            return keep, float(errors.max())
+        # worst key of each segment that is over tolerance
+        over = over[np.lexsort((-errors[over], segments[over]))]
+        first = np.ones(len(over), dtype=bool)
+        first[1:] = segments[over][1:] != segments[over][:-1]
+        keep[over[first]] = True
+
+
+def channel_kind(prop):
+    """ Tolerance key of a pose bone property """
+    return 'rotation' if prop.startswith('rotation') else prop
+
+
+def decimate_channel(frames, values, prop, tolerances=None):
+    """
+    decimate_keys() for one property's components together, measuring
+    quaternion error as an angle; returns (keep, max error)
+    """
+    tolerances = TOLERANCES if tolerances is None else tolerances
+    tolerance = tolerances.get(channel_kind(prop), min(tolerances.values()))
+    error = component_error
+    if prop == 'rotation_quaternion':
+        error = quaternion_error
+    return decimate_keys(frames, values, tolerance, error)
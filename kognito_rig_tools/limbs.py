@@ -0,0 +1,130 @@
+"""
+FK/IK limb definitions, stored per rig as JSON in the armature's
+'kognito_limbs' property (DEFAULT_LIMBS when it has none):
+
+    sides: {side: bone name suffix}
+    limbs: {limb name: definition}, each with:
+        chain: FK chain bones, base to tip, without side suffix
+        iks: IK pole and IK control bones, without side suffix
+        prop_holder: bone holding the IK/FK switch property
+        prop: switch property, side suffix is added
+        layers: {side: [FK layer, IK layer]}, null to leave a layer alone
+
+The Kognito rig's legs are IK only (no switch property, no FK layers), so
+only the arms are defined by default.
+"""
+
+import json
+
+PROPERTY = 'kognito_limbs'
+
+DEFAULT_LIMBS = {
+    'sides': {'left': '.L', 'right': '.R'},
+    'limbs': {
+        'arm': {
+            'chain': ['upper_arm', 'forearm', 'hand'],
+            'iks': ['forearm_ik_pole', 'arm_IK'],
+            'prop_holder': 'props', 'prop': 'IK_arms',
+            'layers': {'left': [6, 5], 'right': [9, 8]}},
+        },
+    }
+
+
+class Limb:
+    """ One side of one limb with all bone and property names resolved """
+
+    def __init__(self, name, side, suffix, definition):
+        self.name = name
+        self.side = side
+        self.chain = [bone + suffix for bone in definition['chain']]
+        self.iks = [bone + suffix for bone in definition['iks']]
+        self.prop_holder = definition.get('prop_holder', 'props')
+        self.prop = definition['prop'] + suffix
+        self.fk_layer, self.ik_layer = definition.get(
+            'layers', {}).get(side, (None, None))
+
+
+class RigLimbs:
+    """ Compiled limb definitions of a rig, Limbs by (limb name, side) """
+
+    def __init__(self, limbs):
+        sides = limbs.get('sides', DEFAULT_LIMBS['sides'])
+        self.names = sorted(limbs.get('limbs', {}))
+        self.sides = sorted(sides)
+        self.limbs = {}
+        for name in self.names:
+            definition = limbs['limbs'][name]
+            for side, suffix in sides.items():
+                self.limbs[name, side] = Limb(name, side, suffix, definition)
+
+    def get(self, name, side):
+        return self.limbs.get((name, side))
+
+    def all(self):
+        """ Every Limb, in name then side order """
+        return [
+            self.limbs[name, side] for name in self.names
+            for side in self.sides]
+
+
+# (limbs JSON, RigLimbs) per armature data pointer
+_rig_limbs = {}
+_default_limbs = RigLimbs(DEFAULT_LIMBS)
+
+
+def get_rig_limbs(ob):
+    """ Compiled limbs of armature object ob, recompiled when edited """
+    text = ob.data.get(PROPERTY)
+    if not text:
+        return _default_limbs
+    key = ob.data.as_pointer()
+    cached = _rig_limbs.get(key)
+    if cached is None or cached[0] != text:
+        cached = _rig_limbs[key] = (text, RigLimbs(json.loads(text)))
+    return cached[1]
+
+
+def store_limbs(ob, limbs):
+    """ Store limb definitions on ob's armature """
+    ob.data[PROPERTY] = json.dumps(limbs, sort_keys=True)
+
+
+def load_limbs(filepath):
+    with open(filepath) as limbs_file:
+        return json.load(limbs_file)
+
+
+def limb_waves(table, limbs, ik):
+    """
+    limbs grouped into waves for a bulk switch to IK (or FK): a limb whose
+    chain hangs below bones an earlier limb's match writes goes in a later
+    wave, so the scene only needs updating between waves. table is the
+    rig's bone_space.BoneTable.
+    """
+    def ancestors(name):
+        found = set()
+        index = table.index[name]
+        while index >= 0:
+            found.add(table.names[index])
+            index = table.parents[index]
+        return found
+
+    reads = [
+        set().union(*(ancestors(bone) for bone in limb.chain))
+        for limb in limbs]
+    writes = [set(limb.iks if ik else limb.chain) for limb in limbs]
+    depth = [0] * len(limbs)
+    for _ in limbs:
+        changed = False
+        for later, read in enumerate(reads):
+            for earlier, written in enumerate(writes):
+                if (earlier != later and written & read and
+                        depth[later] <= depth[earlier]):
+                    depth[later] = depth[earlier] + 1
+                    changed = True
+        if not changed:
+            break
+    waves = [[] for _ in range(max(depth, default=-1) + 1)]
+    for limb, wave in zip(limbs, depth):
+        waves[wave].append(limb)
+    return waves
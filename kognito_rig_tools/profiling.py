@@ -0,0 +1,103 @@
+"""
+Opt-in profiling of the rig tools. While enabled, every phase() block
+records its wall time and item counts (bones, vertices, constraints...);
+the log can be summarised per phase or written as a Chrome trace for
+chrome://tracing or Perfetto. Disabled, phase() costs one flag check.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Oldest events are dropped past this many
+EVENT_LIMIT = 100000
+
+enabled = False
+_events = []
+_origin = time.perf_counter()
+# summary() of _events, None once events are recorded or cleared
+_summary = None
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def clear():
+    global _summary
+    del _events[:]
+    _summary = None
+
+
+@contextmanager
+def phase(name, category='rig', **counts):
+    """
+    Time the enclosed block as phase name. counts are item counts; the
+    block can add more to the yielded dict as it learns them.
+    """
+    global _summary
+    if not enabled:
+        yield counts
+        return
+    start = time.perf_counter()
+    try:
+        yield counts
+    finally:
+        _events.append((
+            name, category, start, time.perf_counter() - start, counts,
+            threading.get_ident()))
+        if len(_events) > EVENT_LIMIT:
+            del _events[:len(_events) - EVENT_LIMIT]
+        _summary = None
+
+
+def profiled(execute):
+    """ Time an operator's execute() as one phase named after it """
+    @functools.wraps(execute)
+    def wrapper(self, context):
+        with phase(self.bl_idname, 'operator'):
+            return execute(self, context)
+    return wrapper
+
+
+def summary():
+    """
+    [(name, calls, total seconds, max seconds, {count: total})] per phase,
+    slowest total first; cached until the next event or clear()
+    """
+    global _summary
+    if _summary is None:
+        _summary = _summarise(_events)
+    return _summary
+
+
+def _summarise(events):
+    phases = {}
+    for name, category, start, duration, counts, thread in events:
+        calls, total, peak, totals = phases.get(name, (0, 0.0, 0.0, {}))
+        for key, value in counts.items():
+            totals[key] = totals.get(key, 0) + value
+        phases[name] = (
+            calls + 1, total + duration, max(peak, duration), totals)
+    return sorted(
+        ((name,) + values for name, values in phases.items()),
+        key=lambda row: row[2], reverse=True)
+
+
+def chrome_trace():
+    """ The event log in Chrome's trace event format """
+    pid = os.getpid()
+    return {'traceEvents': [
+        {'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': thread,
+         'ts': (start - _origin) * 1e6, 'dur': duration * 1e6,
+         'args': counts}
+        for name, category, start, duration, counts, thread in _events]}
+
+
+def write_chrome_trace(filepath):
+    with open(filepath, 'w') as trace_file:
+        json.dump(chrome_trace(), trace_file)
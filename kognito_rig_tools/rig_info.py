@@ -0,0 +1,119 @@
+"""
+Per object descriptors of Kognito rigs for panel poll and draw, so a
+redraw reads attributes instead of looking up bones and ID properties.
+Only names and property paths are kept: pose bones are looked up again
+when drawn, as their pointers don't survive undo or rebuilding the pose.
+"""
+
+from .limbs import get_rig_limbs
+
+# (property on the props bone, label) drawn by the shape panel
+SHAPE_PROPS = [('scale_arms', "Scale Arms"), ('scale_legs', "Scale Legs")]
+
+# (label, rows of (layer, text), big) sections of the Kognito rig's own
+# layers for the Show/Hide box; the limb layers go where LIMB_LAYERS is
+LIMB_LAYERS = None
+KOGNITO_LAYERS = [
+    (None, [[(0, "Head FK")]], True),
+    ("Face", [[(23, "main")], [(24, "tweak")]], False),
+    LIMB_LAYERS,
+    ("Fingers", [[(4, "Main")], [(3, "Tweak")]], False),
+    (None, [[(2, "Torso FK")]], True),
+    ("Legs", [[(15, "IK Right"), (12, "IK Left")]], True),
+    ]
+
+# RigInfo per object pointer, see rig_info()
+_infos = {}
+
+
+class RigInfo:
+    """ What the Kognito panels need to know about one object """
+
+    def __init__(self, ob):
+        self.is_kognito = (
+            ob.type == 'ARMATURE' and 'kognito_rig' in ob)
+        # name of the bone holding the shape properties, None if missing
+        self.props = None
+        self.shape_props = []
+        self.limbs = []
+        # KOGNITO_LAYERS with the limb layers filled in
+        self.layers = []
+        if not self.is_kognito:
+            return
+        pose_bones = ob.pose.bones
+        props = pose_bones.get('props')
+        if props:
+            self.props = props.name
+            self.shape_props = [
+                ('["{}"]'.format(prop), text) for prop, text in SHAPE_PROPS
+                if prop in props]
+        rig_limbs = get_rig_limbs(ob)
+        for name in rig_limbs.names:
+            sides = []
+            for side in reversed(rig_limbs.sides):
+                limb = rig_limbs.get(name, side)
+                holder = pose_bones.get(limb.prop_holder)
+                path = None
+                if holder and limb.prop in holder:
+                    path = '["{}"]'.format(limb.prop)
+                sides.append((limb, path))
+            self.limbs.append((name, sides))
+        self.layers = layer_sections(self.limbs)
+
+
+def layer_sections(limbs):
+    """
+    KOGNITO_LAYERS with a section per limb of RigInfo.limbs, FK and IK
+    layers of each side; fixed layers a limb also uses are left out
+    """
+    limb_sections = []
+    used = set()
+    for name, sides in limbs:
+        rows = []
+        for kind in ('fk', 'ik'):
+            row = [
+                (getattr(limb, kind + '_layer'), "{} {}".format(
+                    kind.upper(), limb.side.title()))
+                for limb, path in sides
+                if getattr(limb, kind + '_layer') is not None]
+            if row:
+                rows.append(row)
+                used.update(layer for layer, text in row)
+        if rows:
+            limb_sections.append(("{}s".format(name.title()), rows, False))
+    sections = []
+    for section in KOGNITO_LAYERS:
+        if section is LIMB_LAYERS:
+            sections.extend(limb_sections)
+            continue
+        label, rows, big = section
+        rows = [
+            [(layer, text) for layer, text in row if layer not in used]
+            for row in rows]
+        rows = [row for row in rows if row]
+        if rows:
+            sections.append((label, rows, big))
+    return sections
+
+
+def rig_info(ob):
+    """ Cached RigInfo of ob, until invalidate_rig_infos() drops it """
+    key = ob.as_pointer()
+    cached = _infos.get(key)
+    if cached is None:
+        cached = _infos[key] = (ob, RigInfo(ob))
+    return cached[1]
+
+
+def invalidate_rig_infos(updated=None):
+    """ Drop the cached descriptors of objects updated() is true for """
+    if updated is None:
+        _infos.clear()
+        return
+    for key, (ob, info) in list(_infos.items()):
+        try:
+            stale = updated(ob)
+        except ReferenceError:
+            stale = True
+        if stale:
+            del _infos[key]
@@ -0,0 +1,147 @@
+"""
+Constraint rules for rig setup, kept as data so character families can
+ship their own as JSON. Per rig role ('ctrl', 'def'):
+
+    inherit_scale: bone name prefixes that keep scale inheritance
+    use_deform: value forced on every bone, or null to leave it alone
+    constraints: list of rules, applied in order to matching bones:
+        prefix / name: bone name prefix, or exact bone name
+        type: constraint type
+        constraint_name: optional, to keep several of the same type apart
+        target, pole_target: rig role to use as (pole) target
+        subtarget, pole_subtarget: templates using {name}, {base}
+            (name up to the first '.') and {suffix} (the rest)
+        properties: constraint attributes set as is
+        bone_length: constraint attributes set to the bone's rest length
+            (Bone.length)
+        set_inverse: compute a CHILD_OF inverse matrix
+"""
+
+import json
+
+PREFIX, EXACT = 0, 1
+
+IK_ARM = {
+    'type': 'IK', 'target': 'ctrl', 'subtarget': '{base}_ik{suffix}',
+    'pole_target': 'ctrl', 'pole_subtarget': '{base}_ik_pole{suffix}',
+    'properties': {'pole_angle': -1.5708, 'chain_count': 2}}
+
+
+def copy_rule(match, constraint, space=None, kind='prefix'):
+    """ Copy constraint from the same named control bone """
+    rule = {
+        kind: match, 'type': constraint, 'target': 'ctrl',
+        'subtarget': '{name}'}
+    if space:
+        rule['properties'] = {'target_space': space, 'owner_space': space}
+    return rule
+
+
+DEFAULT_RULES = {
+    'ctrl': {
+        'inherit_scale': ['palm', 'thumb', 'f_'],
+        'use_deform': False,
+        'constraints': [
+            dict(IK_ARM, prefix='forearm.'),
+            # IK targets follow the shoulder; the poles are left free
+            {'prefix': 'forearm_ik.', 'type': 'CHILD_OF', 'target': 'ctrl',
+             'subtarget': 'shoulder{suffix}', 'set_inverse': True},
+            dict(IK_ARM, prefix='shin.'),
+            {'prefix': 'shin.', 'type': 'LIMIT_ROTATION',
+             'properties': {
+                 'use_limit_y': True, 'use_limit_z': True,
+                 'owner_space': 'POSE'}},
+            {'prefix': 'foot.', 'type': 'IK', 'target': 'ctrl',
+             'subtarget': '{base}_ik{suffix}',
+             'properties': {'chain_count': 1}},
+            {'prefix': 'toe.', 'type': 'IK', 'target': 'ctrl',
+             'subtarget': '{base}_ik{suffix}',
+             'properties': {'chain_count': 1}},
+            ],
+        },
+    'def': {
+        'inherit_scale': ['palm', 'thumb', 'f_'],
+        'use_deform': None,
+        'constraints': [
+            copy_rule('hips', 'COPY_LOCATION', 'LOCAL'),
+            copy_rule('hips', 'COPY_ROTATION', 'POSE'),
+            copy_rule('thigh', 'COPY_LOCATION', 'POSE'),
+            copy_rule('thigh', 'COPY_ROTATION', 'POSE'),
+            copy_rule('spine', 'COPY_ROTATION', 'LOCAL'),
+            copy_rule('chest', 'COPY_ROTATION', 'LOCAL'),
+            copy_rule('upper_arm', 'COPY_ROTATION', 'LOCAL'),
+            copy_rule('palm', 'COPY_LOCATION'),
+            copy_rule('thumb.01', 'COPY_LOCATION'),
+            copy_rule('head', 'COPY_SCALE', 'LOCAL', kind='name'),
+            copy_rule('head', 'COPY_ROTATION', 'LOCAL', kind='name'),
+            copy_rule('neck', 'COPY_ROTATION', 'LOCAL', kind='name'),
+            {'prefix': '', 'type': 'STRETCH_TO', 'target': 'ctrl',
+             'subtarget': '{name}', 'bone_length': ['rest_length'],
+             'properties': {'head_tail': 1, 'volume': 'NO_VOLUME'}},
+            ],
+        },
+    }
+
+
+class RuleTrie:
+    """ Prefix trie of constraint rules, finds all matches in one walk """
+
+    def __init__(self, rules):
+        self.root = {}
+        self.cache = {}
+        for order, rule in enumerate(rules):
+            kind = PREFIX if 'prefix' in rule else EXACT
+            node = self.root
+            for char in rule['prefix'] if kind == PREFIX else rule['name']:
+                node = node.setdefault(char, {})
+            node.setdefault(kind, []).append((order, rule))
+
+    def match(self, name):
+        """ Rules matching bone name, in rule table order """
+        try:
+            return self.cache[name]
+        except KeyError:
+            pass
+        node = self.root
+        found = list(node.get(PREFIX, ()))
+        for char in name:
+            node = node.get(char)
+            if node is None:
+                break
+            found.extend(node.get(PREFIX, ()))
+        else:
+            found.extend(node.get(EXACT, ()))
+        rules = self.cache[name] = [rule for order, rule in sorted(
+            found, key=lambda item: item[0])]
+        return rules
+
+
+class RigRules:
+    """ Compiled rules for one rig role """
+
+    def __init__(self, rules):
+        self.inherit_scale = tuple(rules.get('inherit_scale', ()))
+        self.use_deform = rules.get('use_deform')
+        self.constraints = RuleTrie(rules.get('constraints', ()))
+
+    def inherits_scale(self, name):
+        return name.startswith(self.inherit_scale)
+
+
+def compile_rules(rules=None):
+    """ {role: RigRules} from a rule table, by default DEFAULT_RULES """
+    if rules is None:
+        rules = DEFAULT_RULES
+    return {role: RigRules(role_rules) for role, role_rules in rules.items()}
+
+
+def load_rules(filepath):
+    """ Compiled rules from a JSON rule table file """
+    with open(filepath) as rules_file:
+        return compile_rules(json.load(rules_file))
+
+
+def template_names(name):
+    """ Values available to subtarget templates for bone name """
+    base, dot, rest = name.partition('.')
+    return {'name': name, 'base': base, 'suffix': dot + rest}
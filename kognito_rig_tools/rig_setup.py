@@ -0,0 +1,374 @@
+"""
+Constraint setup for the Kognito control (rig_ctrl) and deform (rig_def)
+rigs, usable interactively or headless over many .blend files:
+
+blender --background --python rig_setup-constraints.py -- FILES_OR_DIRS
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import bpy
+import numpy as np
+
+from .bone_space import invalidate_bone_tables
+from .constraints import ConstraintIndex
+from .rig_rules import compile_rules, load_rules, template_names
+
+CTRL_RIG = 'rig_ctrl'
+DEF_RIG = 'rig_def'
+
+
+# Largest CHILD_OF inverse matrix element difference left alone
+INVERSE_TOLERANCE = 1e-5
+
+
+def child_of_inverse(child_of):
+    """
+    The matrix the Set Inverse button would store, None if the target or
+    subtarget bone does not exist
+    """
+    target = child_of.target
+    if target is None:
+        return None
+    matrix = target.matrix_world
+    if child_of.subtarget:
+        bone = target.pose.bones.get(child_of.subtarget) if (
+            target.type == 'ARMATURE') else None
+        if bone is None:
+            return None
+        matrix = matrix * bone.matrix
+    return matrix.inverted()
+
+
+def set_child_of_inverse(child_of):
+    """
+    Same result as the Set Inverse button, without an operator call;
+    False if the inverse could not be computed
+    """
+    inverse = child_of_inverse(child_of)
+    if inverse is None:
+        return False
+    child_of.inverse_matrix = inverse
+    return True
+
+
+def missing_inverse(bone, con):
+    """ Problem line for a CHILD_OF whose inverse could not be set """
+    return '{} {}: subtarget {} not found in {}, inverse not set'.format(
+        bone.name, con.name, con.subtarget,
+        con.target.name if con.target else None)
+
+
+def rule_state(bone, rule, rigs):
+    """ {constraint attribute: value} rule wants on pose bone """
+    names = template_names(bone.name)
+    state = {}
+    for attr in ('target', 'pole_target'):
+        if attr in rule:
+            state[attr] = rigs[rule[attr]]
+    for attr in ('subtarget', 'pole_subtarget'):
+        if attr in rule:
+            state[attr] = rule[attr].format(**names)
+    state.update(rule.get('properties', {}))
+    for attr in rule.get('bone_length', ()):
+        state[attr] = bone.bone.length
+    return state
+
+
+def missing_subtargets(state):
+    """
+    The (attribute, bone name, rig) of a rule_state() whose subtarget bone
+    is not in its target rig
+    """
+    missing = []
+    for attr, sub_attr in (
+            ('target', 'subtarget'), ('pole_target', 'pole_subtarget')):
+        target, subtarget = state.get(attr), state.get(sub_attr)
+        if (subtarget and target is not None and
+                target.type == 'ARMATURE' and
+                target.pose.bones.get(subtarget) is None):
+            missing.append((sub_attr, subtarget, target.name))
+    return missing
+
+
+def skipped_rule(bone, rule, missing):
+    """ Problem line for a rule left out for missing subtargets """
+    return '{} {}: {}, rule skipped'.format(
+        bone.name, rule.get('constraint_name', rule['type']), ', '.join(
+            '{} {} not found in {}'.format(attr, name, rig)
+            for attr, name, rig in missing))
+
+
+def state_value(value):
+    """
+    value in a form that compares equal when writing it would change
+    nothing: floats at Blender's single precision, IDs by pointer
+    """
+    if isinstance(value, float):
+        return float(np.float32(value))
+    if hasattr(value, 'as_pointer'):
+        return value.as_pointer()
+    if hasattr(value, '__len__') and not isinstance(value, str):
+        return tuple(state_value(item) for item in value)
+    return value
+
+
+def matrix_difference(a, b):
+    """ Largest element difference of two matrices """
+    return max(
+        abs(value_a - value_b)
+        for row_a, row_b in zip(a, b)
+        for value_a, value_b in zip(row_a, row_b))
+
+
+def apply_rule(bone, rule, rigs, index, problems=None):
+    """
+    Find or add the constraint rule describes on pose bone. Rules whose
+    subtarget bones don't exist are skipped; those and rules that can't be
+    fully applied are described in problems, if given. Returns whether
+    the rule was applied.
+    """
+    state = rule_state(bone, rule, rigs)
+    missing = missing_subtargets(state)
+    if missing:
+        if problems is not None:
+            problems.append(skipped_rule(bone, rule, missing))
+        return False
+    con = index.find_or_add(
+        bone, rule['type'], rule.get('constraint_name'))
+    for attr, value in state.items():
+        setattr(con, attr, value)
+    if rule.get('set_inverse') and not set_child_of_inverse(con):
+        if problems is not None:
+            problems.append(missing_inverse(bone, con))
+    return True
+
+
+def update_rule(bone, rule, rigs, index, problems=None):
+    """
+    apply_rule() writing only the attributes that differ from the rule;
+    returns their names, ['constraint'] if it had to be added or [] if
+    the rule was skipped
+    """
+    state = rule_state(bone, rule, rigs)
+    missing = missing_subtargets(state)
+    if missing:
+        if problems is not None:
+            problems.append(skipped_rule(bone, rule, missing))
+        return []
+    con = index.find(bone, rule['type'], rule.get('constraint_name'))
+    if con is None:
+        apply_rule(bone, rule, rigs, index, problems)
+        return ['constraint']
+    changed = []
+    for attr, value in state.items():
+        if state_value(getattr(con, attr)) != state_value(value):
+            setattr(con, attr, value)
+            changed.append(attr)
+    if rule.get('set_inverse'):
+        inverse = child_of_inverse(con)
+        if inverse is None:
+            if problems is not None:
+                problems.append(missing_inverse(bone, con))
+        elif changed or matrix_difference(
+                con.inverse_matrix, inverse) > INVERSE_TOLERANCE:
+            con.inverse_matrix = inverse
+            changed.append('inverse_matrix')
+    return changed
+
+
+def apply_rig_rules(ob, rig_rules, rigs, bones=None, problems=None):
+    """ Apply one role's RigRules to ob's pose bones (default all) """
+    for bone in ob.data.bones:
+        bone.use_inherit_scale = rig_rules.inherits_scale(bone.name)
+        if rig_rules.use_deform is not None:
+            bone.use_deform = rig_rules.use_deform
+    match = rig_rules.constraints.match
+    index = ConstraintIndex(ob)
+    for bone in ob.pose.bones if bones is None else bones:
+        for rule in match(bone.name):
+            apply_rule(bone, rule, rigs, index, problems)
+
+
+def update_rig_rules(ob, rig_rules, rigs, bones=None, problems=None):
+    """
+    apply_rig_rules() writing only what differs from the rules, so
+    unchanged bones are not tagged for update or stored by undo again.
+    Returns [(bone name, bone flags or constraint, [attributes])].
+    """
+    changes = []
+    for bone in ob.data.bones:
+        flags = []
+        inherit_scale = rig_rules.inherits_scale(bone.name)
+        if bone.use_inherit_scale != inherit_scale:
+            bone.use_inherit_scale = inherit_scale
+            flags.append('use_inherit_scale')
+        use_deform = rig_rules.use_deform
+        if use_deform is not None and bone.use_deform != use_deform:
+            bone.use_deform = use_deform
+            flags.append('use_deform')
+        if flags:
+            changes.append((bone.name, 'bone', flags))
+    match = rig_rules.constraints.match
+    index = ConstraintIndex(ob)
+    for bone in ob.pose.bones if bones is None else bones:
+        for rule in match(bone.name):
+            changed = update_rule(bone, rule, rigs, index, problems)
+            if changed:
+                changes.append((
+                    bone.name, rule.get('constraint_name', rule['type']),
+                    changed))
+    return changes
+
+
+def setup_rigs(
+        ctrl, deform, bones=None, rules=None, diff=False, problems=None):
+    """
+    Set up whichever of the control and deform rigs are given, using
+    compiled rules (default rig_rules.DEFAULT_RULES). With diff only
+    what differs is written, and {role: update_rig_rules()} is returned.
+    Rules that could not be fully applied are described in problems.
+    """
+    if rules is None:
+        rules = compile_rules()
+    rigs = {'ctrl': ctrl, 'def': deform}
+    changes = {}
+    for role, ob in (('ctrl', ctrl), ('def', deform)):
+        if ob and role in rules:
+            if diff:
+                changes[role] = update_rig_rules(
+                    ob, rules[role], rigs, bones, problems)
+            else:
+                apply_rig_rules(ob, rules[role], rigs, bones, problems)
+    return changes if diff else None
+
+
+def change_lines(changes):
+    """ Readable lines of setup_rigs() diff output """
+    return [
+        '{} {} {}: {}'.format(role, bone, what, ', '.join(attrs))
+        for role, role_changes in sorted(changes.items())
+        for bone, what, attrs in role_changes]
+
+
+def setup_file(
+        filepath, ctrl_name=CTRL_RIG, def_name=DEF_RIG, save=True,
+        rules=None, diff=False):
+    """
+    Open a .blend, set up its rigs and save it; returns a report dict.
+    With diff the changes are listed and unchanged files are not saved.
+    """
+    report = {
+        'file': filepath, 'error': None, 'changes': None, 'problems': []}
+    start = time.perf_counter()
+    try:
+        bpy.ops.wm.open_mainfile(filepath=filepath)
+        # the new file's armatures can reuse the previous file's pointers
+        invalidate_bone_tables()
+        report['load'] = time.perf_counter() - start
+        ctrl = bpy.data.objects.get(ctrl_name)
+        deform = bpy.data.objects.get(def_name)
+        if not ctrl:
+            raise LookupError("No control rig named {}".format(ctrl_name))
+        setup_start = time.perf_counter()
+        changes = setup_rigs(
+            ctrl, deform, rules=rules, diff=diff,
+            problems=report['problems'])
+        report['setup'] = time.perf_counter() - setup_start
+        if diff:
+            report['changes'] = change_lines(changes)
+        if save and not (diff and not report['changes']):
+            bpy.ops.wm.save_mainfile()
+    except Exception as error:
+        report['error'] = '{}: {}'.format(type(error).__name__, error)
+    report['total'] = time.perf_counter() - start
+    return report
+
+
+def blend_files(paths):
+    """ .blend files from a list of files and directories """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.blend'))))
+        else:
+            files.append(path)
+    return files
+
+
+def setup_files(
+        paths, ctrl_name=CTRL_RIG, def_name=DEF_RIG, save=True, rules=None,
+        diff=False):
+    """ setup_file() over many files, printing timing as it goes """
+    if rules is None:
+        rules = compile_rules()
+    reports = []
+    for filepath in blend_files(paths):
+        report = setup_file(filepath, ctrl_name, def_name, save, rules, diff)
+        reports.append(report)
+        print('{:8.3f}s {} {}'.format(
+            report['total'], filepath, report['error'] or 'ok'))
+        for line in report['problems'] + (report['changes'] or []):
+            print('    ' + line)
+    failed = sum(1 for report in reports if report['error'])
+    print('{} files, {} failed, {:.3f}s'.format(
+        len(reports), failed, sum(report['total'] for report in reports)))
+    return reports
+
+
+def setup_active(context):
+    """
+    Original interactive behaviour: active rig, selected pose bones. Only
+    what differs from the rules is written, and printed.
+    """
+    ob = context.active_object
+    if ob is None or ob.type != 'ARMATURE' or (
+            ob.name not in (CTRL_RIG, DEF_RIG)):
+        print('{} is not a Kognito rig, make {} or {} active'.format(
+            ob.name if ob else 'The active object', CTRL_RIG, DEF_RIG))
+        return
+    bones = context.selected_pose_bones
+    changes, problems = {}, []
+    if ob.name == CTRL_RIG:
+        changes = setup_rigs(ob, None, bones, diff=True, problems=problems)
+    else:
+        changes = setup_rigs(bpy.data.objects[CTRL_RIG], ob, bones, {
+            'def': compile_rules()['def']}, diff=True, problems=problems)
+    lines = problems + change_lines(changes)
+    print('\n'.join(lines) or 'Rig already matches the rules')
+
+
+def main(argv=None):
+    """ Command line entry, arguments come after blender's '--' """
+    if argv is None:
+        argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    if not argv:
+        setup_active(bpy.context)
+        return
+    parser = argparse.ArgumentParser(
+        prog='rig_setup-constraints.py',
+        description='Set up Kognito rig constraints in .blend files')
+    parser.add_argument('paths', nargs='+', help='.blend files or folders')
+    parser.add_argument('--ctrl', default=CTRL_RIG, help='control rig name')
+    parser.add_argument('--def', dest='deform', default=DEF_RIG,
+                        help='deform rig name')
+    parser.add_argument('--no-save', dest='save', action='store_false',
+                        help='do not save the files')
+    parser.add_argument('--rules', help='JSON rule table to use')
+    parser.add_argument('--diff', action='store_true',
+                        help='only write and list what differs from the '
+                             'rules, do not save unchanged files')
+    parser.add_argument('--report', help='write the timings as JSON here')
+    args = parser.parse_args(argv)
+    rules = load_rules(args.rules) if args.rules else compile_rules()
+    reports = setup_files(
+        args.paths, args.ctrl, args.deform, args.save, rules, args.diff)
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(reports, report_file, indent=2)
+    return reports
@@ -1,4 +1,18 @@
 import bpy
+import numpy as np
+
+from .bake import (
+    bake_actions, bake_deform_rig, control_actions, decimate_action,
+    decimate_lines, decimate_summary, mute_constraints)
+from .bone_map import BoneMap, FACE_RULES, VENDOR_RULES, load_name_rules
+from .constraints import ConstraintIndex
+from . import profiling
+from .profiling import phase, profiled
+from .rig_setup import CTRL_RIG, DEF_RIG
+from .validate import validate_rigs
+
+# Slowest phases listed in the panel's profiling section
+PROFILE_ROWS = 12
 
 
 class RigLinkFaceBones(bpy.types.Operator):
@@ -6,25 +20,46 @@ class RigLinkFaceBones(bpy.types.Operator):
     bl_idname = "pose.rig_face_link"
     bl_label = "Add copy transforms onto face rig"
     bl_context = "pose"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    layer = bpy.props.IntProperty(
+        name="Face Layer", default=16, min=0, max=31,
+        description="Bone layer of the face rig bones to link")
 
     @classmethod
     def poll(cls, context):
         return (
-            len(context.selected_objects) == 2 and
+            len(context.selected_objects) >= 2 and
             context.object and
             all(ob.type == 'ARMATURE' for ob in context.selected_objects))
 
+    @profiled
     def execute(self, context):
         active = context.active_object
-        selected = [
-            ob for ob in context.selected_objects if ob is not active][0]
-        face_link(active, selected)
+        rigs = [ob for ob in context.selected_objects if ob != active]
+        linked = sum(face_link(active, rig, self.layer) for rig in rigs)
+        self.report({'INFO'}, "Linked {} bones on {} face rigs".format(
+            linked, len(rigs)))
+        return {'FINISHED'}
 
 
 class RigCopyBoneTransforms(bpy.types.Operator):
-    """Copy bone transformms from a source armature to a target"""
+    """Copy bone transformms from a source armature to targets"""
     bl_idname = "pose.rig_copy_bone_transforms"
     bl_label = "Copy Bone XForms from Source to Target"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    target_group = bpy.props.StringProperty(
+        name="Target Group",
+        description="Copy to the armatures in this group instead of the "
+        "selected ones")
+    match_names = bpy.props.BoolProperty(
+        name="Match Naming Schemes", default=False,
+        description="Match bones across ORG-/DEF- prefixes and .L/_l side "
+        "suffix styles")
+    name_map = bpy.props.StringProperty(
+        name="Name Map", subtype='FILE_PATH',
+        description="JSON bone name rules and table, used instead")
 
     @classmethod
     def poll(cls, context):
@@ -32,14 +67,50 @@ class RigCopyBoneTransforms(bpy.types.Operator):
             context.mode == 'OBJECT' or
             (context.mode == 'POSE' and context.selected_pose_bones))
 
+    def draw(self, context):
+        layout = self.layout
+        layout.prop_search(self, 'target_group', bpy.data, 'groups')
+        layout.prop(self, 'match_names')
+        layout.prop(self, 'name_map')
+
+    @profiled
     def execute(self, context):
         source = context.active_object
-        target = [obj for obj in context.selected_objects if obj != source][0]
+        if self.target_group:
+            group = bpy.data.groups.get(self.target_group)
+            if group is None:
+                self.report({'ERROR'}, "No group named {}".format(
+                    self.target_group))
+                return {'CANCELLED'}
+            candidates = group.objects
+        else:
+            candidates = context.selected_objects
+        # bones are edited in the scene, so targets have to be linked to it
+        scene_objects = context.scene.objects
+        targets = [
+            obj for obj in candidates
+            if obj != source and obj.type == 'ARMATURE' and
+            obj.name in scene_objects]
+        if not targets:
+            self.report({'WARNING'}, "No target armatures")
+            return {'CANCELLED'}
+        if self.name_map:
+            name_rules = load_name_rules(bpy.path.abspath(self.name_map))
+        else:
+            name_rules = VENDOR_RULES if self.match_names else None
         if context.mode == 'OBJECT':
-            copy_bone_transforms(source, target)
+            bones = None
         else:
             bones = [b.name for b in context.selected_pose_bones]
-            copy_bone_transforms(source, target, bones)
+        bone_maps = transfer_bone_transforms(
+            source, targets, bones, name_rules)
+        for target, bone_map in zip(targets, bone_maps):
+            if (bone_map.unmapped or bone_map.collisions or
+                    bone_map.ambiguous):
+                self.report({'WARNING'}, "{}: {}".format(
+                    target.name, bone_map.report()))
+        self.report({'INFO'}, "Copied bones to {} armatures".format(
+            len(targets)))
         return {'FINISHED'}
 
 
@@ -58,6 +129,158 @@ class RigORGDeform(bpy.types.Operator):
         return {'FINISHED'}
 
 
+class RigUnityBake(bpy.types.Operator):
+    """Bake the deform rig's constraints to plain keys for Unity export"""
+    bl_idname = "pose.rig_unity_bake"
+    bl_label = "Bake deform rig for Unity"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    control_rig = bpy.props.StringProperty(
+        name="Control Rig", default='rig_ctrl')
+    all_actions = bpy.props.BoolProperty(
+        name="All Actions", default=False,
+        description="Bake every control rig action, not just the scene range")
+    mute = bpy.props.BoolProperty(
+        name="Mute Constraints", default=False,
+        description="Mute the deform rig constraints after baking")
+    validate = bpy.props.BoolProperty(
+        name="Validate", default=True,
+        description="Check both rigs first and list problems in the console")
+    decimate = bpy.props.BoolProperty(
+        name="Decimate", default=True,
+        description="Drop keys that linear interpolation reproduces")
+    location_tolerance = bpy.props.FloatProperty(
+        name="Location Tolerance", default=0.001, min=0.0, precision=4)
+    rotation_tolerance = bpy.props.FloatProperty(
+        name="Rotation Tolerance", default=0.001, min=0.0, precision=4,
+        subtype='ANGLE')
+    scale_tolerance = bpy.props.FloatProperty(
+        name="Scale Tolerance", default=0.001, min=0.0, precision=4)
+
+    @classmethod
+    def poll(cls, context):
+        return context.object and context.object.type == 'ARMATURE'
+
+    def draw(self, context):
+        layout = self.layout
+        layout.prop_search(self, 'control_rig', context.scene, 'objects')
+        layout.prop(self, 'all_actions')
+        layout.prop(self, 'mute')
+        layout.prop(self, 'validate')
+        layout.prop(self, 'decimate')
+        col = layout.column(align=True)
+        col.active = self.decimate
+        col.prop(self, 'location_tolerance', text="Location")
+        col.prop(self, 'rotation_tolerance', text="Rotation")
+        col.prop(self, 'scale_tolerance', text="Scale")
+
+    @profiled
+    def execute(self, context):
+        scene = context.scene
+        deform = context.object
+        ctrl = scene.objects.get(self.control_rig)
+        if not ctrl or ctrl == deform:
+            self.report({'ERROR'}, "Control rig not found")
+            return {'CANCELLED'}
+        if self.validate:
+            report_rigs(
+                self, validate_rigs(
+                    scene.objects, {'ctrl': ctrl, 'def': deform}))
+        tolerances = None
+        if self.decimate:
+            tolerances = {
+                'location': self.location_tolerance,
+                'rotation': self.rotation_tolerance,
+                'scale': self.scale_tolerance}
+        if self.all_actions:
+            baked = bake_actions(
+                scene, ctrl, deform, control_actions(ctrl, deform),
+                tolerances=tolerances)
+            for name, frames, seconds, ratio, decimation in baked:
+                print('{}: {} frames {:.1f}x'.format(name, frames, ratio))
+                for line in decimate_lines(decimation or {}):
+                    print('    ' + line)
+            self.report({'INFO'}, "Baked {} actions".format(len(baked)))
+        else:
+            frames = range(scene.frame_start, scene.frame_end + 1)
+            action = bake_deform_rig(scene, deform, frames, objects=[ctrl])
+            if tolerances:
+                report = decimate_action(action, tolerances)
+                print('\n'.join(decimate_lines(report)))
+                keys, kept, ratio = decimate_summary(report)
+                self.report({'INFO'}, "Kept {} of {} keys ({:.1f}x)".format(
+                    kept, keys, ratio))
+        if self.mute:
+            mute_constraints(deform)
+        return {'FINISHED'}
+
+
+class RigValidate(bpy.types.Operator):
+    """Check the control and deform rigs for problems that break export"""
+    bl_idname = "pose.rig_validate"
+    bl_label = "Validate rigs"
+
+    @classmethod
+    def poll(cls, context):
+        return context.object and context.object.type == 'ARMATURE'
+
+    @profiled
+    def execute(self, context):
+        objects = context.scene.objects
+        rigs = {'ctrl': objects.get(CTRL_RIG), 'def': objects.get(DEF_RIG)}
+        if context.object not in rigs.values():
+            rigs = {None: context.object}
+        reports = validate_rigs(objects, rigs)
+        if report_rigs(self, reports) == 0:
+            self.report({'INFO'}, "No problems found")
+        return {'FINISHED'}
+
+
+def report_rigs(operator, reports):
+    """ Print validation issues and report a summary, returns the count """
+    count = 0
+    for rig_report in reports:
+        for line in rig_report.lines():
+            print(rig_report.rig, line)
+        count += len(rig_report.issues)
+    if count:
+        operator.report({'WARNING'}, "{}, see the console".format(
+            "; ".join(rig_report.summary() for rig_report in reports)))
+    return count
+
+
+class RigProfileClear(bpy.types.Operator):
+    """Forget the recorded profiling phases"""
+    bl_idname = "wm.rig_profile_clear"
+    bl_label = "Clear"
+
+    def execute(self, context):
+        profiling.clear()
+        return {'FINISHED'}
+
+
+class RigProfileExport(bpy.types.Operator):
+    """Save the recorded phases as a Chrome trace (chrome://tracing)"""
+    bl_idname = "wm.rig_profile_export"
+    bl_label = "Export Trace"
+
+    filepath = bpy.props.StringProperty(subtype='FILE_PATH')
+
+    def invoke(self, context, event):
+        if not self.filepath:
+            self.filepath = 'rig_profile.json'
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        profiling.write_chrome_trace(bpy.path.abspath(self.filepath))
+        return {'FINISHED'}
+
+
+def profiling_update(self, context):
+    profiling.enable(self.kognito_profiling)
+
+
 class RigUnityUtils(bpy.types.Panel):
     """Creates a Panel in the Object properties window"""
     bl_label = "Rig to Unity"
@@ -74,18 +297,66 @@ class RigUnityUtils(bpy.types.Panel):
         col.label('Bone Utilities')
         col.operator('pose.rig_org_to_deform')
         col.operator('pose.rig_copy_bone_transforms')
+        col.operator('pose.rig_face_link')
+        col.operator('pose.rig_validate')
+        col.operator('pose.rig_unity_bake')
 
+        wm = context.window_manager
+        box = layout.box()
+        row = box.row()
+        row.prop(
+            wm, 'kognito_profile_show', text="Profiling", emboss=False,
+            icon='TRIA_DOWN' if wm.kognito_profile_show else 'TRIA_RIGHT')
+        row.prop(wm, 'kognito_profiling', text="Record")
+        if wm.kognito_profile_show:
+            col = box.column(align=True)
+            for name, calls, total, peak, counts in (
+                    profiling.summary()[:PROFILE_ROWS]):
+                col.label("{}: {:.1f} ms in {} ({:.1f} max)".format(
+                    name, total * 1000, calls, peak * 1000))
+                if counts:
+                    col.label("    " + ", ".join(
+                        "{} {}".format(key, value)
+                        for key, value in sorted(counts.items())))
+            row = box.row(align=True)
+            row.operator('wm.rig_profile_clear')
+            row.operator('wm.rig_profile_export')
 
-def face_link(ctr, rig):
-    """ Link via constraint def rig to control rig """
-    deform_face_layer = 16
-    for bone in rig.pose.bones:
-        dbone = rig.data.bones[bone.name]
-        if dbone.layers[16]:
-            ctr_bone = bone.name.replace('GEO_', '')
-            cons = bone.constraints.new('COPY_TRANSFORMS')
-            cons.target = ctr
-            cons.subtarget = ctr_bone
+
+def bones_on_layer(bones, layer):
+    """ Names of bones on the given layer, from one foreach_get """
+    layers = np.empty(len(bones) * 32, dtype=bool)
+    bones.foreach_get('layers', layers)
+    on_layer = layers.reshape(-1, 32)[:, layer]
+    return [bone.name for bone, on in zip(bones, on_layer) if on]
+
+
+def face_link(ctr, rig, layer=16, name_rules=FACE_RULES):
+    """
+    Link via constraint def rig to control rig. Bones already linked are
+    left as they are, so rerunning adds no duplicate constraints.
+    Returns the number of constraints added or retargeted.
+    """
+    with phase('face_link.index', bones=len(rig.data.bones)):
+        names = bones_on_layer(rig.data.bones, layer)
+        bone_map = BoneMap(
+            names, [bone.name for bone in ctr.data.bones], name_rules)
+        index = ConstraintIndex(rig)
+    pbones = rig.pose.bones
+    linked = 0
+    with phase('face_link.write', constraints=len(bone_map.mapping)):
+        for name, ctr_bone in bone_map.mapping.items():
+            cons = index.find(pbones[name], 'COPY_TRANSFORMS')
+            if cons is None:
+                cons = index.add(pbones[name], 'COPY_TRANSFORMS')
+            elif cons.target == ctr and cons.subtarget == ctr_bone:
+                continue
+            if cons.target != ctr:
+                cons.target = ctr
+            if cons.subtarget != ctr_bone:
+                cons.subtarget = ctr_bone
+            linked += 1
+    return linked
 
 
 def bones_swap_org_def(bones):
@@ -93,63 +364,182 @@ def bones_swap_org_def(bones):
         bone.bone.use_deform = not bone.bone.use_deform
 
 
-def copy_bone_transforms(source, target, bones=None):
-    # thanks to https://blender.stackexchange.com/a/15940
-    # Assume, that context.object is an armature
-    context = bpy.context
-    scene = context.scene
-    # Store the bone data of source:
-    bpy.ops.object.mode_set(mode='EDIT')
-    bone_store = []
+def bone_rolls(vectors, z_axes):
+    """
+    Edit bone roll for bones with head->tail vectors and rest Z axes,
+    the array form of Blender's mat3_to_vec_roll
+    """
+    nor = vectors / np.linalg.norm(vectors, axis=1)[:, None]
+    x, y, z = nor[:, 0], nor[:, 1], nor[:, 2]
+    theta = 1.0 + y
+    # columns of the roll-less bone matrix (vec_roll_to_mat3, roll 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv = 1.0 / theta
+        near = x * x + z * z
+        xx = np.where(
+            theta > 1.0e-5, 1.0 - x * x * inv, (x + z) * (x - z) / -near)
+        zz = np.where(
+            theta > 1.0e-5, 1.0 - z * z * inv, (x + z) * (x - z) / near)
+        xz = np.where(theta > 1.0e-5, -x * z * inv, 2.0 * x * z / near)
+    flipped = ~((theta > 1.0e-5) | (((x != 0) | (z != 0)) & (theta > 1.0e-9)))
+    x_axis = np.stack([xx, -x, xz], axis=1)
+    z_axis = np.stack([xz, -z, zz], axis=1)
+    x_axis[flipped] = (-1.0, 0.0, 0.0)
+    z_axis[flipped] = (0.0, 0.0, 1.0)
+    return np.arctan2(
+        (x_axis * z_axes).sum(axis=1), (z_axis * z_axes).sum(axis=1))
+
+
+def get_rest_bones(ob):
+    """ Names and (head, tail, roll) arrays of an armature's rest bones """
+    bones = ob.data.bones
+    count = len(bones)
+    heads = np.empty(count * 3, dtype=np.float32)
+    tails = np.empty(count * 3, dtype=np.float32)
+    matrices = np.empty(count * 16, dtype=np.float32)
+    bones.foreach_get('head_local', heads)
+    bones.foreach_get('tail_local', tails)
+    bones.foreach_get('matrix_local', matrices)
+    heads, tails = heads.reshape(-1, 3), tails.reshape(-1, 3)
+    # matrix_local is flattened column by column
+    z_axes = matrices.reshape(-1, 4, 4)[:, 2, :3]
+    rolls = bone_rolls(tails - heads, z_axes).astype(np.float32)
+    return [bone.name for bone in bones], heads, tails, rolls
+
+
+def set_edit_bones(ob, names, heads, tails, rolls):
+    """
+    Write head/tail/roll arrays onto the same named edit bones of ob, which
+    must be in edit mode; returns names and rest lengths of changed bones
+    """
+    ebones = ob.data.edit_bones
+    count = len(ebones)
+    new_heads = np.empty(count * 3, dtype=np.float32)
+    new_tails = np.empty(count * 3, dtype=np.float32)
+    new_rolls = np.empty(count, dtype=np.float32)
+    connected = np.empty(count, dtype=bool)
+    ebones.foreach_get('head', new_heads)
+    ebones.foreach_get('tail', new_tails)
+    ebones.foreach_get('roll', new_rolls)
+    ebones.foreach_get('use_connect', connected)
+    new_heads, new_tails = new_heads.reshape(-1, 3), new_tails.reshape(-1, 3)
+    old_lengths = np.linalg.norm(new_tails - new_heads, axis=1)
+
+    target_names = [ebone.name for ebone in ebones]
+    target_index = {name: index for index, name in enumerate(target_names)}
+    pairs = [
+        (target_index[name], index) for index, name in enumerate(names)
+        if name in target_index]
+    if not pairs:
+        return [], []
+    dst, src = (np.array(column) for column in zip(*pairs))
+    new_heads[dst], new_tails[dst], new_rolls[dst] = (
+        heads[src], tails[src], rolls[src])
+
+    # keep connected bones joined, as setting head/tail one by one would
+    parents = np.array([
+        target_index[ebone.parent.name] if ebone.parent else -1
+        for ebone in ebones])
+    copied = np.zeros(count, dtype=bool)
+    copied[dst] = True
+    joined = np.flatnonzero(connected & (parents >= 0))
+    pull = joined[copied[joined]]
+    new_tails[parents[pull]] = new_heads[pull]
+    follow = joined[~copied[joined]]
+    new_heads[follow] = new_tails[parents[follow]]
+
+    ebones.foreach_set('head', new_heads.ravel())
+    ebones.foreach_set('tail', new_tails.ravel())
+    ebones.foreach_set('roll', new_rolls)
+    lengths = np.linalg.norm(new_tails - new_heads, axis=1)
+    changed = np.flatnonzero(copied | (lengths != old_lengths))
+    return [target_names[i] for i in changed], lengths[changed].tolist()
+
+
+def reset_stretch_lengths(ob, names, lengths):
+    """ Set STRETCH_TO rest_length of pose bones to their new rest lengths """
+    pbones = ob.pose.bones
+    for name, length in zip(names, lengths):
+        for constraint in pbones[name].constraints:
+            if constraint.type == 'STRETCH_TO':
+                constraint.rest_length = length
+
+
+def transfer_bone_transforms(source, targets, bones=None, name_rules=None):
+    """
+    Copy rest head/tail/roll of source bones (default all) onto the
+    matching bones of every target armature, matched by bone_map name_rules
+    (default identical names). The source is read from its rest bones
+    without entering edit mode; each target gets one edit session.
+    Returns the BoneMap used for each target.
+    """
+    scene = bpy.context.scene
+    active = scene.objects.active
+    mode = active.mode if active else 'OBJECT'
+    with phase('copy_bones.extract', bones=len(source.data.bones)):
+        names, heads, tails, rolls = get_rest_bones(source)
     if bones:
-        source_bones = (source.data.edit_bones[b] for b in bones)
-    else:
-        source_bones = source.data.edit_bones
-    for ebone in source_bones:
-        bone_store.append([
-            ebone.name, ebone.head.copy(), ebone.tail.copy(), ebone.roll])
-    bpy.ops.object.mode_set(mode='OBJECT')
-
-    scene.objects.active = target
-    bpy.ops.object.mode_set(mode='EDIT')
-
-    # Transfer the bones to the other armature.
-    # The following works because the bone data is defined in local space:
-
-    ebones = target.data.edit_bones
-    for bone_data in bone_store:
-        bid = bone_data[0]
-        if bid in ebones:
-            ebone = ebones[bid]
-            ebone.head = bone_data[1].copy()
-            ebone.tail = bone_data[2].copy()
-            ebone.roll = bone_data[3]
-
-    # If bone length has been altered we need to reset stretch to rest length
-    bpy.ops.object.mode_set(mode='POSE')
-    target.data.pose_position = 'REST'
-    target.update_tag()
-    bpy.context.scene.update()
-    pbones = target.pose.bones
-    for bone_data in bone_store:
-        bid = bone_data[0]
-        if bid in pbones:
-            pbone = pbones[bid]
-            for constraint in pbone.constraints:
-                if constraint.type == 'STRETCH_TO':
-                    constraint.rest_length = pbone.length
-    target.data.pose_position = 'POSE'
-    bpy.ops.object.mode_set(mode='OBJECT')
-    scene.objects.active = source
+        wanted = set(bones)
+        keep = [i for i, name in enumerate(names) if name in wanted]
+        names = [names[i] for i in keep]
+        heads, tails, rolls = heads[keep], tails[keep], rolls[keep]
+    if mode != 'OBJECT':
+        with phase('copy_bones.mode_switch'):
+            bpy.ops.object.mode_set(mode='OBJECT')
+    bone_maps = []
+    for target in targets:
+        with phase('copy_bones.map', bones=len(names)):
+            bone_map = BoneMap(
+                names, [bone.name for bone in target.data.bones], name_rules)
+        bone_maps.append(bone_map)
+        scene.objects.active = target
+        with phase('copy_bones.mode_switch'):
+            bpy.ops.object.mode_set(mode='EDIT')
+        with phase('copy_bones.write', bones=len(bone_map.mapping)):
+            changed = set_edit_bones(
+                target, bone_map.map_names(names), heads, tails, rolls)
+        with phase('copy_bones.mode_switch'):
+            bpy.ops.object.mode_set(mode='OBJECT')
+        # If bone length has been altered we need to reset stretch to length
+        with phase('copy_bones.stretch', bones=len(changed[0])):
+            reset_stretch_lengths(target, *changed)
+    scene.objects.active = active
+    if mode != 'OBJECT':
+        with phase('copy_bones.mode_switch'):
+            bpy.ops.object.mode_set(mode=mode)
+    return bone_maps
+
+
+def copy_bone_transforms(source, target, bones=None, name_rules=None):
+    """ Copy rest bone transforms from source to target armature """
+    return transfer_bone_transforms(source, [target], bones, name_rules)[0]
 
 
 def register():
+    bpy.types.WindowManager.kognito_profiling = bpy.props.BoolProperty(
+        name="Profile Rig Tools", default=False, update=profiling_update,
+        description="Record time and item counts of rig tool phases")
+    bpy.types.WindowManager.kognito_profile_show = bpy.props.BoolProperty(
+        name="Show Profiling", default=False)
+    bpy.utils.register_class(RigProfileClear)
+    bpy.utils.register_class(RigProfileExport)
     bpy.utils.register_class(RigUnityUtils)
     bpy.utils.register_class(RigCopyBoneTransforms)
     bpy.utils.register_class(RigORGDeform)
+    bpy.utils.register_class(RigLinkFaceBones)
+    bpy.utils.register_class(RigUnityBake)
+    bpy.utils.register_class(RigValidate)
 
 
 def unregister():
+    bpy.utils.unregister_class(RigProfileExport)
+    bpy.utils.unregister_class(RigProfileClear)
+    del bpy.types.WindowManager.kognito_profile_show
+    del bpy.types.WindowManager.kognito_profiling
+    profiling.enable(False)
+    bpy.utils.unregister_class(RigValidate)
+    bpy.utils.unregister_class(RigUnityBake)
+    bpy.utils.unregister_class(RigLinkFaceBones)
     bpy.utils.unregister_class(RigUnityUtils)
     bpy.utils.unregister_class(RigCopyBoneTransforms)
     bpy.utils.unregister_class(RigORGDeform)
@@ -1,6 +1,16 @@
 import bpy
-from mathutils import Vector, Matrix, Euler, Quaternion
-from mathutils.geometry import normal, intersect_point_line
+import numpy as np
+from bpy.app.handlers import persistent
+from mathutils import Matrix
+
+from .bake import (
+    key_channels, read_pose, record_pose_matrices, set_pose_channels,
+    target_values)
+from .bone_space import get_bone_table, invalidate_bone_tables
+from .constraints import find_or_add_constraint
+from .limbs import get_rig_limbs, limb_waves, load_limbs, store_limbs
+from .profiling import phase, profiled
+from .rig_info import invalidate_rig_infos, rig_info
 
 
 class RigToggleHandFollow(bpy.types.Operator):
@@ -53,83 +63,247 @@ class FKIKSwitcher(bpy.types.Operator):
     bl_description = 'Kognito rig FK IK seamless switcher'
 
     ik = bpy.props.BoolProperty(default=True)
-    side = bpy.props.EnumProperty(
-        items=[('left', 'left', 'left'), ('right', 'right', 'right')])
+    limb = bpy.props.StringProperty(default='arm')
+    side = bpy.props.StringProperty(default='left')
+
+    @classmethod
+    def poll(cls, context):
+        return context.mode == 'POSE' and rig_info(context.object).is_kognito
+
+    @staticmethod
+    def fk_targets(ob, table, pose, chain, iks):
+        """ FK chain keeping its current (..., bones, 4, 4) pose """
+        return {
+            bone: (pose[..., table.index[bone], :, :], ('rotation', 'scale'))
+            for bone in chain}
+
+    @staticmethod
+    def ik_targets(ob, table, pose, chain, iks):
+        """ IK target and pole placed on the current FK chain pose """
+        index = table.index
+        offset = np.eye(4)
+        for constraint in ob.pose.bones[chain[-2]].constraints:
+            if constraint.type == 'IK':
+                # the IK may aim at a child of the bone the animator moves
+                actual = index[constraint.subtarget]
+                offset = table.rest_inverse[actual] @ table.rest[
+                    index[iks[-1]]]
+        # pole keeps its rest offset from the chain base
+        base = index[chain[0]]
+        pole_offset = np.eye(4)
+        pole_offset[:3, 3] = (
+            table.rest_inverse[base] @ table.rest[index[iks[0]]])[:3, 3]
+        return {
+            iks[-1]: (
+                pose[..., index[chain[-1]], :, :] @ offset,
+                ('location', 'rotation')),
+            iks[0]: (pose[..., base, :, :] @ pole_offset, ('location',)),
+            }
+
+    @classmethod
+    def switch(cls, ob, limbs, ik, table=None, problems=None):
+        """
+        Match limbs (limbs.Limb) of ob to IK or FK and show their controls,
+        solving all of them in one batch against the current pose. Switch
+        properties that don't exist are not created but described in
+        problems, if given.
+        """
+        if table is None:
+            table = get_bone_table(ob)
+        with phase('fkik.extract', bones=len(table.names)):
+            pose = read_pose(ob, table)
+        with phase('fkik.math', limbs=len(limbs)) as counts:
+            targets = {}
+            for limb in limbs:
+                match = cls.ik_targets if ik else cls.fk_targets
+                targets.update(match(ob, table, pose, limb.chain, limb.iks))
+            values = target_values(ob, table, pose[None], targets)
+            counts['bones'] = len(targets)
+        with phase('fkik.write', channels=len(values)):
+            set_pose_channels(ob, values)
+        for limb in limbs:
+            if ik:
+                for bone in limb.chain:
+                    ob.pose.bones[bone].matrix_basis = Matrix()
+            for layer, show in ((limb.fk_layer, not ik), (limb.ik_layer, ik)):
+                if layer is not None:
+                    ob.data.layers[layer] = show
+            holder = ob.pose.bones.get(limb.prop_holder)
+            if holder is not None and limb.prop in holder:
+                holder[limb.prop] = 1.0 if ik else 0.0
+            elif problems is not None:
+                problems.append(missing_switch(ob, limb))
+
+    @profiled
+    def execute(self, context):
+        ob = context.object
+        limb = get_rig_limbs(ob).get(self.limb, self.side)
+        if limb is None:
+            self.report(
+                {'ERROR'}, "No {} {} limb".format(self.side, self.limb))
+            return {'CANCELLED'}
+        problems = []
+        self.switch(ob, [limb], self.ik, problems=problems)
+        if problems:
+            self.report({'WARNING'}, '\n'.join(problems))
+        return {'FINISHED'}
+
+
+def missing_switch(ob, limb):
+    """ Problem line for a limb whose switch property does not exist """
+    return '{}: switch property {} not found on bone {}'.format(
+        ob.name, limb.prop, limb.prop_holder)
+
+
+def switch_rigs(scene, rigs, ik, names=None, problems=None):
+    """
+    Switch every limb (or those named in names) of every rig to IK or FK.
+    Each rig's limbs are solved in one batch per wave (limbs.limb_waves),
+    with one scene update between waves for all rigs together; returns
+    the number of limbs switched. Missing switch properties are described
+    in problems, if given.
+    """
+    plans = []
+    for ob in rigs:
+        table = get_bone_table(ob)
+        limbs = [
+            limb for limb in get_rig_limbs(ob).all()
+            if (names is None or limb.name in names) and
+            all(bone in table.index for bone in limb.chain + limb.iks)]
+        plans.append((ob, table, limb_waves(table, limbs, ik)))
+    count = 0
+    for wave in range(max((len(waves) for *_, waves in plans), default=0)):
+        if wave:
+            with phase('fkik.scene_update', rigs=len(plans)):
+                scene.update()
+        for ob, table, waves in plans:
+            if wave < len(waves):
+                FKIKSwitcher.switch(
+                    ob, waves[wave], ik, table, problems)
+                count += len(waves[wave])
+    return count
+
+
+class FKIKSwitchAll(bpy.types.Operator):
+    """Switch all limbs of the active and selected Kognito rigs"""
+    bl_idname = 'pose.kognito_fkik_all'
+    bl_label = 'Kognito Rig FK IK Switch All'
+    bl_options = {'REGISTER', 'UNDO'}
+
+    ik = bpy.props.BoolProperty(name="To IK", default=True)
+    limb = bpy.props.StringProperty(
+        name="Limb", default='',
+        description="Only switch limbs with this name, all when empty")
 
-    # should later use some kind of preset/config system
-    chain = ['upper_arm', 'forearm', 'hand']
-    iks = ['forearm_ik_pole', 'arm_IK']
-    suffixes = {'left': '.L', 'right': '.R'}
-    prop = ['props', 'IK_arms']
-    layers = {'left': [6, 5], 'right': [9, 8]}
+    @classmethod
+    def poll(cls, context):
+        return FKIKSwitcher.poll(context)
+
+    @profiled
+    def execute(self, context):
+        rigs = [context.object] + [
+            ob for ob in context.selected_objects
+            if ob != context.object and rig_info(ob).is_kognito]
+        problems = []
+        count = switch_rigs(
+            context.scene, rigs, self.ik,
+            {self.limb} if self.limb else None, problems)
+        if problems:
+            self.report({'WARNING'}, '\n'.join(problems))
+        self.report({'INFO'}, "Switched {} limbs on {} rigs".format(
+            count, len(rigs)))
+        return {'FINISHED'}
+
+
+class FKIKBake(bpy.types.Operator):
+    """Key the FK/IK match over a frame range, solved for all frames at once"""
+    bl_idname = 'pose.kognito_fkik_bake'
+    bl_label = 'Kognito Rig FK IK Bake'
+    bl_options = {'REGISTER', 'UNDO'}
+
+    ik = bpy.props.BoolProperty(name="To IK", default=True)
+    limb = bpy.props.StringProperty(name="Limb", default='arm')
+    side = bpy.props.StringProperty(name="Side", default='left')
+    frame_start = bpy.props.IntProperty(name="Start", default=1)
+    frame_end = bpy.props.IntProperty(name="End", default=250)
 
     @classmethod
     def poll(cls, context):
-        return (
-            context.mode == 'POSE' and 'kognito_rig' in context.object.keys()
-            )
-
-    def fk_match(self, ob, chain, iks):
-        for bone in chain:
-            pose_bone = ob.pose.bones[bone]
-            bake_rotation_scale(pose_bone)
-
-    def ik_match(self, ob, chain, iks):
-        target = ob.pose.bones[iks[-1]]
-        source = ob.pose.bones[chain[-1]]
-        constraints = (
-            c for c in ob.pose.bones[chain[-2]].constraints if c.type == 'IK'
-            )
-        for constraint in constraints:
-            pole_angle = constraint.pole_angle
-            actual_ik = ob.pose.bones[constraint.subtarget]
-        use_tail = False
-        if not actual_ik is target:
-            # calculate offset
-            target_rest = ob.data.bones[target.name].matrix_local
-            actual_rest = ob.data.bones[actual_ik.name].matrix_local
-            offset = actual_rest.inverted() * target_rest
-        else:
-            offset = None
-        loc_copy(source, target, use_tail, offset)
-        rot_copy(source, target, offset)
-        # use the pole angle to figure out the rest
-        pole_position(
-            [ob.pose.bones[b] for b in chain],
-            ob.pose.bones[iks[0]],
-            pole_angle)
-        for bone in chain:
-            ob.pose.bones[bone].matrix_basis = Matrix()
+        return FKIKSwitcher.poll(context)
+
+    def invoke(self, context, event):
+        self.frame_start = context.scene.frame_start
+        self.frame_end = context.scene.frame_end
+        return context.window_manager.invoke_props_dialog(self)
 
+    @profiled
     def execute(self, context):
         ob = context.object
-        suffix = self.suffixes[self.side]
-        chain = ["{}{}".format(c, suffix) for c in self.chain]
-        iks = ["{}{}".format(c, suffix) for c in self.iks]
-        prop_holder = ob.pose.bones[self.prop[0]]
-        prop = '{}{}'.format(self.prop[1], suffix)
-        influence = prop_holder[prop]
+        limb = get_rig_limbs(ob).get(self.limb, self.side)
+        if limb is None:
+            self.report(
+                {'ERROR'}, "No {} {} limb".format(self.side, self.limb))
+            return {'CANCELLED'}
+        if self.frame_end < self.frame_start:
+            self.report({'ERROR'}, "End frame is before the start frame")
+            return {'CANCELLED'}
+        frames = np.arange(self.frame_start, self.frame_end + 1)
+        table = get_bone_table(ob)
+        with phase('fkik_bake.record', frames=len(frames)):
+            pose = record_pose_matrices(context.scene, ob, frames, table)
         if self.ik:
-            ob.data.layers[self.layers[self.side][-1]] = True
-            ob.data.layers[self.layers[self.side][0]] = False
-            self.ik_match(ob, chain, iks)
-            prop_holder[prop] = 1.0
+            targets = FKIKSwitcher.ik_targets(
+                ob, table, pose, limb.chain, limb.iks)
         else:
-            ob.data.layers[self.layers[self.side][-1]] = False
-            ob.data.layers[self.layers[self.side][0]] = True
-            self.fk_match(ob, chain, iks)
-            prop_holder[prop] = 0.0
+            targets = FKIKSwitcher.fk_targets(
+                ob, table, pose, limb.chain, limb.iks)
+        with phase('fkik_bake.math', frames=len(frames), bones=len(targets)):
+            values = target_values(ob, table, pose, targets)
+        holder = ob.pose.bones.get(limb.prop_holder)
+        if holder is not None and limb.prop in holder:
+            values[limb.prop_holder, '["{}"]'.format(limb.prop)] = np.full(
+                (len(frames), 1), 1.0 if self.ik else 0.0)
+        else:
+            self.report({'WARNING'}, missing_switch(ob, limb))
+        with phase('fkik_bake.write', channels=len(values)):
+            key_channels(ob, frames, values)
         return {'FINISHED'}
 
 
+class LimbsLoad(bpy.types.Operator):
+    """Store FK/IK limb definitions from a JSON file on the active rig"""
+    bl_idname = 'pose.kognito_limbs_load'
+    bl_label = 'Load Kognito Limbs'
+    bl_options = {'REGISTER', 'UNDO'}
+
+    filepath = bpy.props.StringProperty(subtype='FILE_PATH')
 
-def find_or_add_constraint(bone, constraint):
-    con = [con for con in bone.constraints if con.type in constraint]
-    if not con:
-        con = bone.constraints.new(type=constraint)
-    else:
-        con = con[0]
-    return con
+    @classmethod
+    def poll(cls, context):
+        return context.object and context.object.type == 'ARMATURE'
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        store_limbs(context.object, load_limbs(self.filepath))
+        invalidate_rig_infos()
+        return {'FINISHED'}
+
+
+@persistent
+def rig_cache_update(scene):
+    """ Drop bone tables and rig descriptors of updated rigs """
+    invalidate_bone_tables(lambda data: data.is_updated)
+    invalidate_rig_infos(
+        lambda ob: ob.is_updated or (ob.data and ob.data.is_updated))
+
+
+@persistent
+def rig_cache_clear(*args):
+    invalidate_bone_tables()
+    invalidate_rig_infos()
 
 
 def constraints_toggle_child_of(bones):
@@ -144,130 +318,6 @@ def bones_toggle_property(bones, property_name):
         setattr(bone.bone, property_name, not prop_value)
 
 
-def bake_rotation_scale(bone):
-    """ bake constrained transform into bone rot/scale """
-    data_bone = bone.id_data.data.bones[bone.name]
-    bone_mat = data_bone.matrix_local
-    parentless_mat = bone_mat.inverted() * bone.matrix
-    if not bone.parent:
-        rot_mat = scale_mat = parentless_mat
-    else:
-        parentposemat = bone.parent.matrix
-        parentbonemat = data_bone.parent.matrix_local
-        parented_mat = (
-            (parentbonemat.inverted() * bone_mat).inverted() *
-            parentposemat.inverted() *
-            bone.matrix
-            )
-        rot_mat = (
-            parented_mat if data_bone.use_inherit_rotation else parentless_mat)
-        scale_mat = (
-            parented_mat if data_bone.use_inherit_scale else parentless_mat)
-
-    if bone.rotation_mode == 'AXIS_ANGLE':
-        bone.rotation_axis_angle = rot_mat.to_quaternion().to_axis_angle()
-    elif bone.rotation_mode == 'QUATERNION':
-        bone.rotation_quaternion = rot_mat.to_quaternion()
-    else:
-        bone.rotation_euler = rot_mat.to_euler(
-            bone.rotation_mode, bone.rotation_euler)
-    bone.scale = scale_mat.to_scale()
-
-
-def loc_copy(source, target, use_tail, offset):
-    data_target = target.id_data.data.bones[target.name]
-    target_mat = data_target.matrix_local
-    if not data_target.use_local_location:
-        target_mat = Matrix.Translation(target_mat.to_translation())
-    if use_tail:
-        location = source.tail
-    else:
-        location = source.matrix.to_translation()
-    if target.parent:
-        parentposemat = target.parent.matrix
-        parentbonemat = data_target.parent.matrix_local
-        target.location = (
-            (parentbonemat.inverted() * target_mat).inverted() *
-            parentposemat.inverted() *
-            location
-            )
-    else:
-        target.location = target_mat.inverted() * location
-    if offset:
-        target.location = target.location + offset.to_translation()
-
-
-def rot_copy(source, target, offset):
-    """ duplicates code from loc_copy, should be refactored """
-    data_target = target.id_data.data.bones[target.name]
-    target_mat = data_target.matrix_local
-    parentless_mat = target_mat.inverted() * source.matrix
-    if not target.parent:
-        mat = parentless_mat
-    else:
-        parentposemat = target.parent.matrix
-        parentbonemat = data_target.parent.matrix_local
-        parented_mat = (
-            (parentbonemat.inverted() * target_mat).inverted() *
-            parentposemat.inverted() *
-            source.matrix
-            )
-        mat = (
-            parented_mat if data_target.use_inherit_rotation else parentless_mat)
-    if offset:
-        offset_rot = offset.to_3x3()
-        quat = mat.to_quaternion()
-        offset_rot.rotate(quat)
-        mat = offset_rot
-    if target.rotation_mode == 'AXIS_ANGLE':
-        target.rotation_axis_angle = mat.to_quaternion().to_axis_angle()
-    elif target.rotation_mode == 'QUATERNION':
-        target.rotation_quaternion = mat.to_quaternion()
-    else:
-        target.rotation_euler = mat.to_euler(
-            target.rotation_mode, target.rotation_euler)
-
-
-
-def genericmat(bone, mat, ignoreparent):
-    '''
-    Puts the matrix mat from armature space into bone space
-    '''
-    data_bone = bone.id_data.data.bones[bone.name]
-    bonemat_local = data_bone.matrix_local  # self rest matrix
-    if bone.parent:
-        parentposemat = bone.parent.matrix
-        parentbonemat = data_bone.parent.matrix_local
-    else:
-        parentposemat = None
-        parentbonemat = None
-    if parentbonemat is None or ignoreparent:
-        newmat = bonemat_local.inverted() * mat
-    else:
-        bonemat = parentbonemat.inverted() * bonemat_local
-        newmat = bonemat.inverted() * parentposemat.inverted() * mat
-    return newmat
-
-
-def pole_position(chain, pole, pole_angle):
-    """
-    pole target based on roll angle of chain base
-    """
-    # Poll target for elbow is on the + X axis, for the knee we need to lock
-    # the elbow to rotate along one axis only
-    chain_0_data = chain[0].id_data.data.bones[chain[0].name]
-    pole_data = pole.id_data.data.bones[pole.name]
-    offmatelbow = chain_0_data.matrix_local.inverted() * pole_data.matrix_local
-    vec = offmatelbow.to_translation()
-    # vec = Vector((4, 0.0, 0.0))
-    # vec.rotate(Euler((0, -pole_angle, 0)))
-    offmatelbow = Matrix.Translation(vec)
-    offmatarm = chain[0].matrix * offmatelbow
-
-    pole.location = genericmat(pole, offmatarm, False).to_translation()
-    return
-
-
 class KognitoShapePanel(bpy.types.Panel):
     """Kognito Shape Manipulation tools"""
     bl_label = "Shape Control"
@@ -279,17 +329,19 @@ class KognitoShapePanel(bpy.types.Panel):
 
     @classmethod
     def poll(cls, context):
-        return 'kognito_rig' in context.object.keys()
+        return context.object and rig_info(context.object).is_kognito
 
     def draw(self, context):
         layout = self.layout
         ob = context.object
-        props = ob.pose.bones["props"]
+        info = rig_info(ob)
 
-        row = layout.row(align=True)
-        row.prop(props, '["scale_arms"]', text="Scale Arms")
-        row = layout.row(align=True)
-        row.prop(props, '["scale_legs"]', text="Scale Legs")
+        props = ob.pose.bones.get(info.props) if info.props else None
+        if props is None:
+            return
+        for path, text in info.shape_props:
+            row = layout.row(align=True)
+            row.prop(props, path, text=text)
 
 
 class KognitoPanel(bpy.types.Panel):
@@ -303,29 +355,50 @@ class KognitoPanel(bpy.types.Panel):
 
     @classmethod
     def poll(cls, context):
-        return 'kognito_rig' in context.object.keys()
+        return context.object and rig_info(context.object).is_kognito
 
     def draw(self, context):
         layout = self.layout
         ob = context.object
+        info = rig_info(ob)
         switcher = FKIKSwitcher.bl_idname
-        props = ob.pose.bones["props"]
-        box = layout.box()
-        box.label("IK/FK arms:")
 
-        def fk_ik_controls(layout, side, prop):
+        def fk_ik_controls(layout, limb, path):
 
-            def clicker(layout, side, state, icon):
+            def clicker(layout, state, icon):
                 clicker = layout.operator(switcher, text="", icon=icon)
-                clicker.side, clicker.ik = side, state
+                clicker.limb, clicker.side, clicker.ik = (
+                    limb.name, limb.side, state)
 
             row = layout.row(align=True)
-            clicker(row, side, False, 'TRIA_LEFT')
-            row.prop(props, prop, text=side)
-            clicker(row, side, True, 'TRIA_RIGHT')
+            clicker(row, False, 'TRIA_LEFT')
+            holder = ob.pose.bones.get(limb.prop_holder) if path else None
+            if holder is not None:
+                row.prop(holder, path, text=limb.side)
+            else:
+                row.label(limb.side)
+            clicker(row, True, 'TRIA_RIGHT')
 
-        fk_ik_controls(box, 'right', '["IK_arms.R"]')
-        fk_ik_controls(box, 'left', '["IK_arms.L"]')
+        box = layout.box()
+        row = box.row(align=True)
+        row.label("All limbs:")
+        for state, text in ((False, 'FK'), (True, 'IK')):
+            row.operator(FKIKSwitchAll.bl_idname, text=text).ik = state
+
+        for name, sides in info.limbs:
+            box = layout.box()
+            box.label("IK/FK {}s:".format(name))
+            for limb, path in sides:
+                fk_ik_controls(box, limb, path)
+
+            row = box.row(align=True)
+            row.label("Bake:")
+            for limb, path in sides:
+                for state, text in ((False, 'FK'), (True, 'IK')):
+                    bake = row.operator(
+                        FKIKBake.bl_idname,
+                        text="{} {}".format(text, limb.side[0]))
+                    bake.limb, bake.side, bake.ik = name, limb.side, state
 
         box = layout.box()
         box.label("Toggles:")
@@ -336,60 +409,47 @@ class KognitoPanel(bpy.types.Panel):
         box = layout.box()
         box.label("Show/Hide:")
 
-        row = box.row(align=True)
-        row.scale_y = 2
-        row.prop(ob.data, "layers", index=0, text="Head FK", toggle=True)
-
-        col = box.column(align=True)
-        row = col.row(align=True)
-        row.label("  Face:")
-        row = col.row(align=True)
-        row.prop(ob.data, "layers", index=23, text="main", toggle=True)
-        row = col.row(align=True)
-        row.prop(ob.data, "layers", index=24, text="tweak", toggle=True)
-
-        col = box.column(align=True)
-        row = col.row(align=True)
-        row.label("  Arms:")
-        row = col.row(align=True)
-        row.prop(ob.data, "layers", index=9, text="FK Right", toggle=True)
-        row.prop(ob.data, "layers", index=6, text="FK Left", toggle=True)
-        row = col.row(align=True)
-        row.prop(ob.data, "layers", index=8, text="IK Right", toggle=True)
-        row.prop(ob.data, "layers", index=5, text="IK Left", toggle=True)
-
-        col = box.column(align=True)
-        row = col.row(align=True)
-        row.label("  Fingers:")
-        row = col.row(align=True)
-        row.prop(ob.data, "layers", index=4, text="Main", toggle=True)
-        row = col.row(align=True)
-        row.prop(ob.data, "layers", index=3, text="Tweak", toggle=True)
-
-        row = box.row(align=True)
-        row.scale_y = 2
-        row.prop(ob.data, "layers", index=2, text="Torso FK", toggle=True)
-
-        col = box.column(align=True)
-        row = col.row(align=True)
-        row.label("  Legs:")
-        row = col.row(align=True)
-        row.scale_y = 2
-        row.prop(ob.data, "layers", index=15, text="IK Right", toggle=True)
-        row.prop(ob.data, "layers", index=12, text="IK Left", toggle=True)
-
+        for label, rows, big in info.layers:
+            if label is None:
+                col = box
+            else:
+                col = box.column(align=True)
+                col.row(align=True).label("  {}:".format(label))
+            for layers in rows:
+                row = col.row(align=True)
+                if big:
+                    row.scale_y = 2
+                for layer, text in layers:
+                    row.prop(
+                        ob.data, "layers", index=layer, text=text,
+                        toggle=True)
 
 def register():
     bpy.utils.register_class(RigToggleHandFollow)
     bpy.utils.register_class(RigToggleHandInheritRotation)
     bpy.utils.register_class(FKIKSwitcher)
+    bpy.utils.register_class(FKIKSwitchAll)
+    bpy.utils.register_class(FKIKBake)
+    bpy.utils.register_class(LimbsLoad)
     bpy.utils.register_class(KognitoPanel)
     bpy.utils.register_class(KognitoShapePanel)
+    bpy.app.handlers.scene_update_post.append(rig_cache_update)
+    bpy.app.handlers.undo_post.append(rig_cache_clear)
+    bpy.app.handlers.redo_post.append(rig_cache_clear)
+    bpy.app.handlers.load_post.append(rig_cache_clear)
 
 
 def unregister():
+    bpy.app.handlers.load_post.remove(rig_cache_clear)
+    bpy.app.handlers.redo_post.remove(rig_cache_clear)
+    bpy.app.handlers.undo_post.remove(rig_cache_clear)
+    bpy.app.handlers.scene_update_post.remove(rig_cache_update)
+    rig_cache_clear()
     bpy.utils.unregister_class(KognitoShapePanel)
     bpy.utils.unregister_class(KognitoPanel)
+    bpy.utils.unregister_class(LimbsLoad)
+    bpy.utils.unregister_class(FKIKBake)
+    bpy.utils.unregister_class(FKIKSwitchAll)
     bpy.utils.unregister_class(FKIKSwitcher)
     bpy.utils.unregister_class(RigToggleHandFollow)
     bpy.utils.unregister_class(RigToggleHandInheritRotation)
@@ -0,0 +1,229 @@
+"""
+Rig checks that catch Unity export problems early: constraint subtargets
+that do not exist, rig_rules constraints that are missing or aim at other
+bones, stale STRETCH_TO rest lengths, vertex groups without a deforming
+bone, and the switch and shape properties the Kognito panels rely on.
+"""
+
+from collections import namedtuple
+
+from .constraints import ConstraintIndex
+from .limbs import get_rig_limbs
+from .rig_info import SHAPE_PROPS
+from .rig_rules import compile_rules, template_names
+from .rig_setup import CTRL_RIG, DEF_RIG
+
+ERROR, WARNING = 'ERROR', 'WARNING'
+ROLES = {CTRL_RIG: 'ctrl', DEF_RIG: 'def'}
+
+Issue = namedtuple('Issue', 'severity check owner item message')
+
+
+class RigReport:
+    """ Issues found on one rig, plus how many items each check looked at """
+
+    def __init__(self, rig_name):
+        self.rig = rig_name
+        self.issues = []
+        self.checked = {}
+
+    def add(self, severity, check, owner, item, message):
+        self.issues.append(Issue(severity, check, owner, item, message))
+
+    @property
+    def errors(self):
+        return [issue for issue in self.issues if issue.severity == ERROR]
+
+    @property
+    def warnings(self):
+        return [issue for issue in self.issues if issue.severity == WARNING]
+
+    def lines(self):
+        return ['{} {}: {} {}: {}'.format(
+            issue.severity, issue.check, issue.owner, issue.item,
+            issue.message) for issue in self.issues]
+
+    def as_dict(self):
+        return {
+            'rig': self.rig, 'checked': self.checked,
+            'issues': [issue._asdict() for issue in self.issues]}
+
+    def summary(self):
+        return "{}: {} errors, {} warnings".format(
+            self.rig, len(self.errors), len(self.warnings))
+
+
+def validate_rig(
+        ob, meshes=(), rigs=None, rules=None, length_tolerance=1e-4,
+        role=None):
+    """
+    Check armature object ob in one pass over its bones and constraints.
+    meshes are the meshes it deforms, rigs the {role: object} rig_rules
+    targets resolve to (rule subtargets of missing roles are not checked)
+    and rules compiled rig rules (default DEFAULT_RULES). role is ob's
+    rig_rules role, by default guessed from its name. Returns a RigReport.
+    """
+    report = RigReport(ob.name)
+    bones = ob.data.bones
+    bone_names = {bone.name for bone in bones}
+    if role is None:
+        role = ROLES.get(ob.name)
+    rigs = dict(rigs or {})
+    if role:
+        rigs.setdefault(role, ob)
+    if rules is None:
+        rules = compile_rules()
+    role_rules = rules.get(role)
+    # bone names of every armature a constraint targets, built once
+    target_bones = {ob.name: bone_names}
+
+    def bones_of(target):
+        names = target_bones.get(target.name)
+        if names is None:
+            names = target_bones[target.name] = {
+                bone.name for bone in target.data.bones}
+        return names
+
+    index = ConstraintIndex(ob)
+    constraint_count = 0
+    # (bone, rig, subtarget) already reported, so rules don't repeat them
+    missing = set()
+    for pose_bone in ob.pose.bones:
+        name = pose_bone.name
+        for constraint in pose_bone.constraints:
+            constraint_count += 1
+            item = '{} "{}"'.format(constraint.type, constraint.name)
+            for attr, sub_attr in (
+                    ('target', 'subtarget'),
+                    ('pole_target', 'pole_subtarget')):
+                target = getattr(constraint, attr, None)
+                subtarget = getattr(constraint, sub_attr, '')
+                if target is None:
+                    if attr == 'target' and hasattr(constraint, attr):
+                        report.add(
+                            WARNING, 'target', name, item, "has no target")
+                    continue
+                if (subtarget and target.type == 'ARMATURE' and
+                        subtarget not in bones_of(target)):
+                    missing.add((name, target.name, subtarget))
+                    report.add(
+                        ERROR, 'subtarget', name, item,
+                        "{} bone {} not found in {}".format(
+                            sub_attr, subtarget, target.name))
+            if constraint.type == 'STRETCH_TO':
+                rest_length = constraint.rest_length
+                length = pose_bone.bone.length
+                if rest_length and abs(rest_length - length) > (
+                        length_tolerance * max(1.0, length)):
+                    report.add(
+                        ERROR, 'rest_length', name, item,
+                        "rest_length {:.4f} but bone length {:.4f}".format(
+                            rest_length, length))
+        if role_rules is None:
+            continue
+        names = template_names(name)
+        for rule in role_rules.constraints.match(name):
+            expected = []
+            for attr, role_attr in (
+                    ('subtarget', 'target'),
+                    ('pole_subtarget', 'pole_target')):
+                rig = rigs.get(rule.get(role_attr))
+                if attr in rule and rig is not None:
+                    expected.append((attr, rig, rule[attr].format(**names)))
+            absent = [
+                (attr, rig, subtarget) for attr, rig, subtarget in expected
+                if subtarget not in bones_of(rig)]
+            # a catch-all rule is skipped on helper bones without a
+            # counterpart, as rig_setup does, so those are only warned about
+            severity = WARNING if rule.get('prefix') == '' else ERROR
+            for attr, rig, subtarget in absent:
+                if (name, rig.name, subtarget) not in missing:
+                    missing.add((name, rig.name, subtarget))
+                    report.add(
+                        severity, 'rule', name, rule['type'],
+                        "rule expects {} {} in {}".format(
+                            attr, subtarget, rig.name))
+            if absent:
+                continue
+            constraint = index.find(
+                pose_bone, rule['type'], rule.get('constraint_name'))
+            if constraint is None:
+                report.add(
+                    ERROR, 'rule', name, rule['type'],
+                    "rule constraint {} missing".format(
+                        rule.get('constraint_name', rule['type'])))
+                continue
+            for attr, rig, subtarget in expected:
+                actual = getattr(constraint, attr, '')
+                if actual != subtarget:
+                    report.add(
+                        ERROR, 'rule', name, rule['type'],
+                        "{} is {} but rule expects {}".format(
+                            attr, actual or None, subtarget))
+    report.checked['bones'] = len(bones)
+    report.checked['constraints'] = constraint_count
+
+    deform = {bone.name for bone in bones if bone.use_deform}
+    group_count = 0
+    for mesh in meshes:
+        for group in mesh.vertex_groups:
+            group_count += 1
+            if group.name in deform:
+                continue
+            message = (
+                "bone does not deform" if group.name in bone_names else
+                "no bone of that name")
+            report.add(
+                WARNING, 'vertex_group', mesh.name, group.name, message)
+    report.checked['vertex_groups'] = group_count
+
+    if 'kognito_rig' in ob:
+        validate_props(ob, report)
+    return report
+
+
+def validate_props(ob, report):
+    """ Limb bones and the switch/shape properties the panels draw """
+    pose_bones = ob.pose.bones
+    holders = set()
+    for limb in get_rig_limbs(ob).all():
+        item = '{} {}'.format(limb.side, limb.name)
+        for bone in limb.chain + limb.iks:
+            if bone not in pose_bones:
+                report.add(
+                    WARNING, 'limb', item, bone, "limb bone not found")
+        holder = pose_bones.get(limb.prop_holder)
+        holders.add(limb.prop_holder)
+        if holder is None:
+            report.add(
+                ERROR, 'props', item, limb.prop_holder,
+                "property bone not found")
+        elif limb.prop not in holder:
+            report.add(
+                ERROR, 'props', limb.prop_holder, limb.prop,
+                "switch property missing")
+    props = pose_bones.get('props')
+    if props is None:
+        if 'props' not in holders:
+            report.add(ERROR, 'props', ob.name, 'props', "bone not found")
+        return
+    for prop, text in SHAPE_PROPS:
+        if prop not in props:
+            report.add(
+                WARNING, 'props', 'props', prop, "shape property missing")
+
+
+def deformed_meshes(objects, rig):
+    """ Meshes among objects that rig deforms through an armature modifier """
+    return [
+        ob for ob in objects
+        if ob.type == 'MESH' and ob.find_armature() == rig]
+
+
+def validate_rigs(objects, rigs, rules=None):
+    """ RigReport of every rig in {role: object}, checked together """
+    rigs = {role: ob for role, ob in rigs.items() if ob}
+    return [
+        validate_rig(
+            ob, deformed_meshes(objects, ob), rigs, rules, role=role)
+        for role, ob in sorted(rigs.items())]
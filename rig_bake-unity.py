@@ -0,0 +1,22 @@
+"""
+Bake the Kognito deform rig (rig_def) to plain keys for Unity export.
+
+Every action animating rig_ctrl is baked into '<action>_unity' on rig_def,
+headless over .blend files and folders:
+
+blender --background --python rig_bake-unity.py -- \
+    [--ctrl rig_ctrl] [--def rig_def] [--suffix _unity] [--mute]
+    [--decimate] [--tolerance LOC ROT SCALE]
+    [--no-save] [--report out.json] PATHS
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from kognito_rig_tools import bake
+
+reports = bake.main()
+if reports and any(report['error'] for report in reports):
+    sys.exit(1)
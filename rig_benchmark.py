@@ -0,0 +1,552 @@
+"""
+Benchmark the rig tools on generated meshes and armatures.
+
+Meshes get random weights in --density groups per vertex; armatures copy
+the control rig of base-mesh.blend (or a minimal Kognito skeleton), cut
+down or padded with face bones to each size. Every case is timed (best of
+--repeat) and checked against a slow reference implementation:
+
+blender --background --python rig_benchmark.py -- \
+    [--vertices 10000 100000 1000000] [--groups 64] [--density 4]
+    [--bones 50 500 2000] [--frames 50] [--crowd 10] [--repeat 3]
+    [--template base-mesh.blend] [--only merge merge_many copy match switch]
+    [--output results.json] [--compare previous.json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import bpy
+import numpy as np
+from mathutils import Matrix
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import vertex_groups_merge
+from kognito_rig_tools import bl_info, bone_space, tools, ui
+from kognito_rig_tools.bake import read_pose
+from kognito_rig_tools.limbs import get_rig_limbs
+from kognito_rig_tools.rig_setup import CTRL_RIG, setup_rigs
+
+CASES = ['merge', 'merge_many', 'copy', 'match', 'switch']
+TOLERANCE = 1e-4
+
+
+def timed(function, repeat, setup=None):
+    """ Best wall time of repeat calls of function and its last result """
+    best, result = None, None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def remove_object(ob):
+    data = ob.data
+    bpy.context.scene.objects.unlink(ob)
+    bpy.data.objects.remove(ob)
+    if data.users == 0:
+        if isinstance(data, bpy.types.Mesh):
+            bpy.data.meshes.remove(data)
+        else:
+            bpy.data.armatures.remove(data)
+
+
+# Meshes
+
+def make_mesh(vertex_count, group_names, density, seed=0):
+    """ Mesh of scattered vertices, each weighted in density random groups """
+    rng = np.random.RandomState(seed)
+    mesh = bpy.data.meshes.new('bench_mesh')
+    mesh.vertices.add(vertex_count)
+    mesh.vertices.foreach_set(
+        'co', rng.uniform(-1.0, 1.0, vertex_count * 3).astype(np.float32))
+    ob = bpy.data.objects.new('bench_mesh', mesh)
+    bpy.context.scene.objects.link(ob)
+    groups = [ob.vertex_groups.new(name) for name in group_names]
+    # 16 weight levels, so one add() per group and level
+    picks = rng.randint(0, len(groups), vertex_count * density)
+    levels = rng.randint(1, 17, vertex_count * density)
+    verts = np.repeat(np.arange(vertex_count), density)
+    keys = picks * 17 + levels
+    order = np.argsort(keys, kind='stable')
+    keys, verts = keys[order], verts[order]
+    splits = np.flatnonzero(np.diff(keys)) + 1
+    starts = np.concatenate([[0], splits])
+    for start, batch in zip(starts, np.split(verts, splits)):
+        group, level = divmod(int(keys[start]), 17)
+        groups[group].add(batch.tolist(), level / 16.0, 'REPLACE')
+    return ob
+
+
+def group_weights(entries, group_index):
+    """ {vertex: weight} of one group from get_weight_entries() output """
+    verts, groups, weights = entries
+    found = groups == group_index
+    return dict(zip(verts[found].tolist(), weights[found].tolist()))
+
+
+def reference_add(entries, target_index, source_indices):
+    """ The per vertex ADD merge the addon started out with """
+    result = group_weights(entries, target_index)
+    for source_index in source_indices:
+        for vert, weight in group_weights(entries, source_index).items():
+            result[vert] = min(1.0, max(0.0, result.get(vert, 0.0) + weight))
+    return result
+
+
+def weights_error(expected, actual):
+    """ Largest weight difference, inf if the vertex sets differ """
+    if set(expected) != set(actual):
+        return float('inf')
+    return max(
+        [abs(expected[vert] - actual[vert]) for vert in expected] or [0.0])
+
+
+def bench_merge(size, args, many=False):
+    names = ['group_{:03d}'.format(i) for i in range(args.groups)]
+    state = {}
+
+    def setup():
+        if 'ob' in state:
+            remove_object(state['ob'])
+        state['ob'] = make_mesh(size, names, args.density)
+        vertex_groups_merge.invalidate_weight_index()
+
+    def run():
+        ob = state['ob']
+        if many:
+            vertex_groups_merge.merge_weight_groups(
+                ob, {names[0]: names[1:len(names) // 2]}, 'ADD')
+        else:
+            vertex_groups_merge.merge_weights_to_group(
+                ob, ob.vertex_groups[names[0]], ob.vertex_groups[names[1]],
+                'ADD')
+
+    seconds, _ = timed(run, args.repeat, setup)
+    setup()
+    ob = state['ob']
+    before = vertex_groups_merge.get_weight_entries(ob.data.vertices)
+    sources = range(1, len(names) // 2) if many else [1]
+    start = time.perf_counter()
+    expected = reference_add(before, 0, sources)
+    reference_seconds = time.perf_counter() - start
+    run()
+    after = vertex_groups_merge.get_weight_entries(ob.data.vertices)
+    error = weights_error(expected, group_weights(after, 0))
+    remove_object(ob)
+    return seconds, reference_seconds, error
+
+
+# Armatures
+
+def minimal_skeleton():
+    """ (name, parent, head, tail) of a minimal Kognito style rig """
+    bones = [
+        ('root', None, (0, 0, 0), (0, -0.5, 0)),
+        ('props', 'root', (0, 0.5, 0), (0, 0.5, 0.2)),
+        ('hips', 'root', (0, 0, 1.0), (0, 0, 1.1)),
+        ('spine', 'hips', (0, 0, 1.1), (0, 0, 1.3)),
+        ('chest', 'spine', (0, 0, 1.3), (0, 0, 1.5)),
+        ('neck', 'chest', (0, 0, 1.5), (0, 0, 1.6)),
+        ('head', 'neck', (0, 0, 1.6), (0, 0, 1.8)),
+        ]
+    for suffix, x in (('.L', 1.0), ('.R', -1.0)):
+        hand = (0.75 * x, 0, 1.5)
+        ankle = (0.1 * x, 0, 0.1)
+        bones += [
+            ('shoulder' + suffix, 'chest', (0.05 * x, 0, 1.5),
+             (0.15 * x, 0, 1.5)),
+            ('upper_arm' + suffix, 'shoulder' + suffix, (0.15 * x, 0, 1.5),
+             (0.45 * x, 0.02, 1.5)),
+            ('forearm' + suffix, 'upper_arm' + suffix, (0.45 * x, 0.02, 1.5),
+             hand),
+            ('hand' + suffix, 'forearm' + suffix, hand, (0.85 * x, 0, 1.5)),
+            ('arm_IK' + suffix, 'root', hand, (0.85 * x, 0, 1.5)),
+            ('forearm_ik' + suffix, 'arm_IK' + suffix, hand,
+             (0.8 * x, 0, 1.5)),
+            ('forearm_ik_pole' + suffix, 'root', (0.45 * x, 0.5, 1.5),
+             (0.45 * x, 0.6, 1.5)),
+            ('thigh' + suffix, 'hips', (0.1 * x, 0, 1.0),
+             (0.1 * x, -0.02, 0.5)),
+            ('shin' + suffix, 'thigh' + suffix, (0.1 * x, -0.02, 0.5),
+             ankle),
+            ('foot' + suffix, 'shin' + suffix, ankle, (0.1 * x, -0.15, 0)),
+            ('toe' + suffix, 'foot' + suffix, (0.1 * x, -0.15, 0),
+             (0.1 * x, -0.25, 0)),
+            ('foot_ik' + suffix, 'root', ankle, (0.1 * x, -0.15, 0)),
+            ('shin_ik' + suffix, 'foot_ik' + suffix, ankle,
+             (0.1 * x, 0, 0.2)),
+            ('toe_ik' + suffix, 'foot_ik' + suffix, (0.1 * x, -0.15, 0),
+             (0.1 * x, -0.25, 0)),
+            ('shin_ik_pole' + suffix, 'root', (0.1 * x, -0.5, 0.5),
+             (0.1 * x, -0.6, 0.5)),
+            ]
+    return bones
+
+
+def template_skeleton(filepath):
+    """ minimal_skeleton() style bones of filepath's control rig, if any """
+    if not filepath or not os.path.exists(filepath):
+        return None
+    with bpy.data.libraries.load(filepath) as (data_from, data_to):
+        data_to.objects = [
+            name for name in data_from.objects if name == CTRL_RIG]
+    if not data_to.objects:
+        return None
+    ob = data_to.objects[0]
+    bones = [
+        (bone.name, bone.parent.name if bone.parent else None,
+         tuple(bone.head_local), tuple(bone.tail_local))
+        for bone in ob.data.bones]
+    data = ob.data
+    bpy.data.objects.remove(ob)
+    bpy.data.armatures.remove(data)
+    return bones
+
+
+def sized_skeleton(skeleton, bone_count):
+    """ skeleton cut to bone_count bones or padded with face bone chains """
+    names = {bone[0] for bone in skeleton[:bone_count]}
+    bones = [
+        (name, parent if parent in names else None, head, tail)
+        for name, parent, head, tail in skeleton[:bone_count]]
+    head = 'head' if 'head' in names else bones[0][0]
+    parent = head
+    for i in range(bone_count - len(bones)):
+        if i % 10 == 0:
+            parent = head
+        z = 1.6 + 0.001 * i
+        name = 'face_{:04d}'.format(i)
+        bones.append((name, parent, (0, -0.1, z), (0, -0.12, z)))
+        parent = name
+    return bones
+
+
+def make_armature(skeleton, name='bench_rig', scale=1.0, roll=0.0):
+    """ Armature object with skeleton's bones, all scaled and rolled """
+    scene = bpy.context.scene
+    ob = bpy.data.objects.new(name, bpy.data.armatures.new(name))
+    scene.objects.link(ob)
+    scene.objects.active = ob
+    bpy.ops.object.mode_set(mode='EDIT')
+    ebones = ob.data.edit_bones
+    for bone_name, parent, head, tail in skeleton:
+        ebone = ebones.new(bone_name)
+        ebone.head = [scale * v for v in head]
+        ebone.tail = [scale * v for v in tail]
+        ebone.roll = roll
+        if parent:
+            ebone.parent = ebones[parent]
+    bpy.ops.object.mode_set(mode='OBJECT')
+    return ob
+
+
+def rest_matrices(ob):
+    values = np.empty(len(ob.data.bones) * 16, dtype=np.float32)
+    ob.data.bones.foreach_get('matrix_local', values)
+    return values
+
+
+def bench_copy(size, args):
+    skeleton = sized_skeleton(args.skeleton, size)
+    source = make_armature(skeleton, 'bench_source')
+    state = {}
+
+    def setup():
+        if 'target' in state:
+            remove_object(state['target'])
+        state['target'] = make_armature(skeleton, 'bench_target', 1.1, 0.1)
+
+    seconds, _ = timed(
+        lambda: tools.copy_bone_transforms(source, state['target']),
+        args.repeat, setup)
+    # reference: the target now has the source's rest matrices
+    error = float(np.abs(
+        rest_matrices(source) - rest_matrices(state['target'])).max())
+    remove_object(state['target'])
+    remove_object(source)
+    return seconds, None, error
+
+
+def random_basis(frames, bones, rng):
+    """ (frames, bones, 4, 4) random rotation and location matrices """
+    quats = rng.normal(0.0, 0.3, (frames, bones, 4))
+    quats[..., 0] += 1.0
+    quats /= np.linalg.norm(quats, axis=-1)[..., None]
+    w, x, y, z = np.moveaxis(quats, -1, 0)
+    basis = np.zeros((frames, bones, 4, 4))
+    basis[..., 0, :3] = np.stack(
+        [1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)],
+        axis=-1)
+    basis[..., 1, :3] = np.stack(
+        [2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)],
+        axis=-1)
+    basis[..., 2, :3] = np.stack(
+        [2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)],
+        axis=-1)
+    basis[..., :3, 3] = rng.normal(0.0, 0.05, (frames, bones, 3))
+    basis[..., 3, 3] = 1.0
+    return basis
+
+
+def set_basis(ob, table, basis):
+    """ Write (bones, 4, 4) matrix_basis in table bone order and tag ob """
+    values = basis[table.pose_order].transpose(0, 2, 1)
+    ob.pose.bones.foreach_set(
+        'matrix_basis', values.astype(np.float32).ravel())
+    ob.update_tag({'DATA'})
+
+
+def reference_pose_to_basis(ob, table):
+    """
+    Blender's own per bone conversion of ob's evaluated pose back to
+    matrix_basis, in table bone order
+    """
+    basis = np.empty((len(table.names), 4, 4))
+    for pose_bone in ob.pose.bones:
+        basis[table.index[pose_bone.name]] = ob.convert_space(
+            pose_bone=pose_bone, matrix=pose_bone.matrix,
+            from_space='POSE', to_space='LOCAL')
+    return basis
+
+
+def bench_match(size, args):
+    ob = make_armature(sized_skeleton(args.skeleton, size))
+    rng = np.random.RandomState(1)
+    # mixed flags so the hinge, no scale and non local location paths of
+    # the parent space are all checked
+    for bone in ob.data.bones:
+        (bone.use_inherit_rotation, bone.use_inherit_scale,
+         bone.use_local_location) = (rng.rand(3) < 0.7).tolist()
+    table = bone_space.BoneTable(ob)
+    basis = random_basis(args.frames, len(table.names), rng)
+    basis[..., :3, :3] *= rng.uniform(
+        0.8, 1.25, (args.frames, len(table.names), 1, 3))
+    # the pose matrices Blender evaluates from basis are the input, its
+    # convert_space() the slow reference
+    scene = bpy.context.scene
+    pose = np.empty(basis.shape)
+    expected = np.empty(basis.shape)
+    reference_seconds = 0.0
+    for frame in range(args.frames):
+        set_basis(ob, table, basis[frame])
+        scene.update()
+        pose[frame] = read_pose(ob, table)
+        start = time.perf_counter()
+        expected[frame] = reference_pose_to_basis(ob, table)
+        reference_seconds += time.perf_counter() - start
+    seconds, result = timed(
+        lambda: bone_space.pose_to_basis(table, pose), args.repeat)
+    error = max(
+        float(np.abs(result - expected).max()),
+        float(np.abs(result - basis).max()))
+    remove_object(ob)
+    return seconds, reference_seconds, error
+
+
+def set_basis_channels(pose_bone, matrix, channels):
+    """ Set channels of pose_bone from a matrix_basis, per rotation mode """
+    location, rotation, scale = matrix.decompose()
+    if 'location' in channels:
+        pose_bone.location = location
+    if 'scale' in channels:
+        pose_bone.scale = scale
+    if 'rotation' not in channels:
+        return
+    if pose_bone.rotation_mode == 'QUATERNION':
+        pose_bone.rotation_quaternion = rotation
+    elif pose_bone.rotation_mode == 'AXIS_ANGLE':
+        axis, angle = rotation.to_axis_angle()
+        pose_bone.rotation_axis_angle = [angle] + list(axis)
+    else:
+        pose_bone.rotation_euler = rotation.to_euler(
+            pose_bone.rotation_mode, pose_bone.rotation_euler)
+
+
+def reference_switch(ob, limb, ik):
+    """
+    Switch one limb with mathutils and convert_space() per bone, as the
+    switcher did before it was batched
+    """
+    pose_bones, bones = ob.pose.bones, ob.data.bones
+    chain = [pose_bones[name] for name in limb.chain]
+    if ik:
+        target, pole = pose_bones[limb.iks[-1]], pose_bones[limb.iks[0]]
+        offset = Matrix()
+        for constraint in chain[-2].constraints:
+            if constraint.type == 'IK':
+                offset = (
+                    bones[constraint.subtarget].matrix_local.inverted() *
+                    bones[target.name].matrix_local)
+        pole_offset = Matrix.Translation((
+            bones[chain[0].name].matrix_local.inverted() *
+            bones[pole.name].matrix_local).to_translation())
+        moves = [
+            (target, chain[-1].matrix * offset, ('location', 'rotation')),
+            (pole, chain[0].matrix * pole_offset, ('location',))]
+    else:
+        moves = [
+            (pose_bone, pose_bone.matrix.copy(), ('rotation', 'scale'))
+            for pose_bone in chain]
+    # convert everything against the pose before any of it is written
+    moves = [
+        (pose_bone, ob.convert_space(
+            pose_bone=pose_bone, matrix=matrix,
+            from_space='POSE', to_space='LOCAL'), channels)
+        for pose_bone, matrix, channels in moves]
+    for pose_bone, basis, channels in moves:
+        set_basis_channels(pose_bone, basis, channels)
+    if ik:
+        for pose_bone in chain:
+            pose_bone.matrix_basis = Matrix()
+    holder = pose_bones.get(limb.prop_holder)
+    if holder is not None and limb.prop in holder:
+        holder[limb.prop] = 1.0 if ik else 0.0
+
+
+def switch_one_by_one(scene, ob, ik):
+    """ Reference switch: one limb at a time, updating the scene after each """
+    table = bone_space.get_bone_table(ob)
+    for limb in get_rig_limbs(ob).all():
+        if all(bone in table.index for bone in limb.chain + limb.iks):
+            reference_switch(ob, limb, ik)
+            scene.update()
+
+
+def bench_switch(size, args):
+    skeleton = sized_skeleton(args.skeleton, size)
+    rigs = [
+        make_armature(skeleton, 'bench_rig_{:02d}'.format(i))
+        for i in range(args.crowd)]
+    reference = make_armature(skeleton, 'bench_reference')
+    problems = []
+    for ob in rigs + [reference]:
+        setup_rigs(ob, None, problems=problems)
+    # a cut down rig can lack a rule's CHILD_OF subtarget
+    for line in sorted(set(problems)):
+        print('    ' + line)
+    scene = bpy.context.scene
+    table = bone_space.get_bone_table(reference)
+    basis = random_basis(1, len(table.names), np.random.RandomState(2))[0]
+
+    def pose_rigs():
+        for ob in rigs + [reference]:
+            set_basis(ob, table, basis)
+        scene.update()
+
+    def run():
+        ui.switch_rigs(scene, rigs, True)
+        ui.switch_rigs(scene, rigs, False)
+
+    seconds, _ = timed(run, args.repeat, pose_rigs)
+    # reference: every rig ends up posed like one switched limb by limb with
+    # mathutils, updating the scene in between
+    pose_rigs()
+    error = 0.0
+    for ik in (True, False):
+        ui.switch_rigs(scene, rigs, ik)
+        switch_one_by_one(scene, reference, ik)
+        scene.update()
+        expected = read_pose(reference, table)
+        for ob in rigs:
+            error = max(error, float(np.abs(
+                read_pose(ob, table) - expected).max()))
+    for ob in rigs + [reference]:
+        remove_object(ob)
+    return seconds, None, error
+
+
+def run_case(case, size, args):
+    """ One result dict for case at size """
+    if case == 'merge':
+        seconds, reference, error = bench_merge(size, args)
+    elif case == 'merge_many':
+        seconds, reference, error = bench_merge(size, args, many=True)
+    elif case == 'copy':
+        seconds, reference, error = bench_copy(size, args)
+    elif case == 'match':
+        seconds, reference, error = bench_match(size, args)
+    else:
+        seconds, reference, error = bench_switch(size, args)
+    return {
+        'case': case, 'size': size, 'seconds': seconds,
+        'reference_seconds': reference, 'max_error': error,
+        'ok': None if error is None else error <= TOLERANCE}
+
+
+def compare(results, previous):
+    """ Print the time ratio of each case against a previous run """
+    old = {(r['case'], r['size']): r['seconds'] for r in previous['results']}
+    for result in results:
+        before = old.get((result['case'], result['size']))
+        if before:
+            print('{:12} {:>8} {:8.3f}s -> {:8.3f}s  {:.2f}x'.format(
+                result['case'], result['size'], before, result['seconds'],
+                before / result['seconds']))
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    parser = argparse.ArgumentParser(
+        prog='rig_benchmark.py', description='Benchmark the rig tools')
+    parser.add_argument('--vertices', type=int, nargs='+',
+                        default=[10000, 100000, 1000000])
+    parser.add_argument('--groups', type=int, default=64,
+                        help='vertex groups per mesh')
+    parser.add_argument('--density', type=int, default=4,
+                        help='groups per vertex')
+    parser.add_argument('--bones', type=int, nargs='+',
+                        default=[50, 500, 2000])
+    parser.add_argument('--frames', type=int, default=50,
+                        help='poses converted by the match case')
+    parser.add_argument('--crowd', type=int, default=10,
+                        help='rigs switched together by the switch case')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--template', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'base-mesh.blend'),
+        help='.blend whose control rig names the generated bones')
+    parser.add_argument('--only', nargs='+', choices=CASES, default=CASES)
+    parser.add_argument('--output', help='write the results as JSON here')
+    parser.add_argument('--compare', help='JSON results of an earlier run')
+    args = parser.parse_args(argv)
+    args.skeleton = template_skeleton(args.template) or minimal_skeleton()
+
+    results = []
+    for case in args.only:
+        sizes = args.vertices if case.startswith('merge') else args.bones
+        for size in sizes:
+            result = run_case(case, size, args)
+            results.append(result)
+            print('{case:12} {size:>8} {seconds:8.3f}s ok: {ok}'.format(
+                **result))
+    report = {
+        'version': '.'.join(str(v) for v in bl_info['version']),
+        'blender': bpy.app.version_string, 'numpy': np.__version__,
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'settings': {
+            key: getattr(args, key) for key in (
+                'groups', 'density', 'frames', 'crowd', 'repeat')},
+        'results': results,
+        }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(results, json.load(previous))
+    return report
+
+
+if __name__ == '__main__':
+    report = main()
+    if any(result['ok'] is False for result in report['results']):
+        sys.exit(1)
@@ -38,69 +38,1040 @@ bl_info = {
 Add Another Vertex Group into the Active One
 """
 
-import bpy
+import functools
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+
+try:
+    import bpy
+except ImportError:
+    # Outside Blender, e.g. farm workers processing weight snapshots, only
+    # the array functions are usable
+    bpy = None
+
+try:
+    # Kognito Rig Tools profiling, when that addon is installed
+    from kognito_rig_tools.profiling import phase, profiled
+except ImportError:
+    @contextmanager
+    def phase(name, category='', **counts):
+        yield counts
+
+    def profiled(execute):
+        return execute
+
+# Most meshes whose weight index is kept cached at once
+WEIGHT_INDEX_LIMIT = 16
+_weight_indexes = OrderedDict()
+# Open weight_index_batch() blocks; indexes are only cached inside one
+_batch_depth = 0
+
+
+def get_weight_entries(vertices):
+    """ Sparse (vertex, group, weight) arrays from one pass over vertices """
+    entries = [
+        (vert.index, element.group, element.weight)
+        for vert in vertices for element in vert.groups]
+    if not entries:
+        return (
+            np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32),
+            np.zeros(0, dtype=np.float32))
+    verts, groups, weights = zip(*entries)
+    return (
+        np.array(verts, dtype=np.int32), np.array(groups, dtype=np.int32),
+        np.array(weights, dtype=np.float32))
+
+
+def weight_matrix(entries, group_indices, vertex_count):
+    """
+    Dense (vertex x group) weights for group_indices from sparse entries,
+    plus a boolean matrix of the same shape marking actual membership
+    """
+    verts, groups, weights = entries
+    size = max([int(groups.max()) + 1 if len(groups) else 0] + [
+        index + 1 for index in group_indices])
+    columns = np.full(size, -1, dtype=np.int32)
+    columns[list(group_indices)] = np.arange(len(group_indices))
+    shape = (vertex_count, len(group_indices))
+    matrix = np.zeros(shape, dtype=np.float32)
+    member = np.zeros(shape, dtype=bool)
+    wanted = columns[groups] >= 0
+    rows, cols = verts[wanted], columns[groups[wanted]]
+    matrix[rows, cols] = weights[wanted]
+    member[rows, cols] = True
+    return matrix, member
+
+
+class WeightIndex:
+    """ CSR (vertex -> group, weight) index of a mesh's vertex weights """
+
+    def __init__(self, vertices):
+        verts, self.groups, self.weights = get_weight_entries(vertices)
+        self.vertex_count = len(vertices)
+        self.indptr = np.zeros(self.vertex_count + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(verts, minlength=self.vertex_count),
+            out=self.indptr[1:])
+
+    @classmethod
+    def from_arrays(cls, indptr, groups, weights):
+        """ Index over existing CSR arrays, e.g. loaded from a snapshot """
+        index = cls.__new__(cls)
+        index.indptr = np.asarray(indptr, dtype=np.int64)
+        index.groups = np.asarray(groups, dtype=np.int32)
+        index.weights = np.asarray(weights, dtype=np.float32)
+        index.vertex_count = len(index.indptr) - 1
+        return index
+
+    @classmethod
+    def from_entries(cls, verts, groups, weights, vertex_count):
+        """ Index of sparse (vertex, group, weight) arrays in any order """
+        order = np.lexsort((groups, verts))
+        indptr = np.zeros(vertex_count + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(verts, minlength=vertex_count), out=indptr[1:])
+        return cls.from_arrays(indptr, groups[order], weights[order])
+
+    @property
+    def rows(self):
+        """ Vertex index of every stored entry """
+        return np.repeat(
+            np.arange(self.vertex_count, dtype=np.int32),
+            np.diff(self.indptr))
+
+    def entries(self):
+        """ Sparse (vertex, group, weight) arrays, as get_weight_entries """
+        return self.rows, self.groups, self.weights
+
+    def matrix(self, group_indices):
+        """ Dense weights and membership for group_indices """
+        return weight_matrix(self.entries(), group_indices, self.vertex_count)
+
+    def with_changes(self, changes):
+        """
+        New index with {group index: group_weight_changes()-style tuple}
+        applied: removed vertices leave the group, the others get values
+        """
+        if not changes:
+            return self
+        rows, groups, weights = self.entries()
+        size = max(
+            [int(groups.max()) + 1 if len(groups) else 0] +
+            [group + 1 for group in changes])
+        keys = rows.astype(np.int64) * size + groups
+        new_rows, new_groups, new_weights, dropped = [], [], [], []
+        for group, (removed, indices, values) in changes.items():
+            dropped.append(np.asarray(removed, dtype=np.int64) * size + group)
+            dropped.append(np.asarray(indices, dtype=np.int64) * size + group)
+            new_rows.append(np.asarray(indices, dtype=np.int32))
+            new_groups.append(np.full(len(indices), group, dtype=np.int32))
+            new_weights.append(np.asarray(values, dtype=np.float32))
+        keep = ~np.isin(keys, np.concatenate(dropped))
+        return WeightIndex.from_entries(
+            np.concatenate([rows[keep]] + new_rows),
+            np.concatenate([groups[keep]] + new_groups),
+            np.concatenate([weights[keep]] + new_weights),
+            self.vertex_count)
+
+
+def weight_signature(ob):
+    """ Cheap check that a cached index still fits ob's mesh layout """
+    return len(ob.data.vertices), len(ob.vertex_groups)
+
+
+@contextmanager
+def weight_index_batch():
+    """
+    Reuse WeightIndexes within the enclosed block, e.g. several weight
+    operations run back to back by a script. Writes made by this module
+    update the cached index; weight edits made by other tools can't be
+    detected cheaply, so the cache is dropped when the outermost batch
+    ends.
+    """
+    global _batch_depth
+    _batch_depth += 1
+    try:
+        yield
+    finally:
+        _batch_depth -= 1
+        if not _batch_depth:
+            invalidate_weight_index()
+
+
+def get_weight_index(ob):
+    """
+    WeightIndex of mesh object ob, cached while a weight_index_batch() is
+    open and built afresh otherwise
+    """
+    if not _batch_depth:
+        return WeightIndex(ob.data.vertices)
+    key = ob.data.as_pointer()
+    signature = weight_signature(ob)
+    cached = _weight_indexes.pop(key, None)
+    if cached is None or cached[0] != signature:
+        cached = signature, WeightIndex(ob.data.vertices)
+    _weight_indexes[key] = cached
+    while len(_weight_indexes) > WEIGHT_INDEX_LIMIT:
+        _weight_indexes.popitem(last=False)
+    return cached[1]
+
+
+def batched(execute):
+    """ Run an operator's execute() inside one weight_index_batch() """
+    @functools.wraps(execute)
+    def wrapper(self, context):
+        with weight_index_batch():
+            return execute(self, context)
+    return wrapper
+
+
+def update_weight_index(mesh, changes):
+    """
+    Keep the cached index of mesh current after this module wrote changes,
+    {group index: group_weight_changes()-style tuple}, to its groups
+    """
+    key = mesh.as_pointer()
+    cached = _weight_indexes.get(key)
+    if cached is not None:
+        _weight_indexes[key] = cached[0], cached[1].with_changes(changes)
+
+
+def invalidate_weight_index(mesh=None):
+    """ Drop the cached index of mesh, or of every mesh """
+    if mesh is None:
+        _weight_indexes.clear()
+    else:
+        _weight_indexes.pop(mesh.as_pointer(), None)
+
+
+def get_weight_matrix(ob, weight_groups):
+    """ Dense weights and membership of weight_groups on mesh object ob """
+    return get_weight_index(ob).matrix(
+        [group.index for group in weight_groups])
+
+
+def set_group_weights(weight_group, indices, weights):
+    """ Write weights to indices using one add() per distinct weight """
+    if not len(indices):
+        return
+    values, inverse = np.unique(weights, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    splits = np.cumsum(np.bincount(inverse))[:-1]
+    for value, batch in zip(values, np.split(indices[order], splits)):
+        weight_group.add(batch.tolist(), float(value), 'REPLACE')
 
 
 def get_verts_in_group(vertices, weight_group):
     """ List weights as floats or None if vertex not in weight_group """
-    v_list = []
-    index = weight_group.index
-    for vert in vertices:
-        # print(vert.index)
-        result = [
-            vertex_group.weight for vertex_group in vert.groups
-            if vertex_group.group == index]
-        if result:
-            v_list.append(result[0])
-        else:
-            v_list.append(None)
+    verts, groups, weights = get_weight_entries(vertices)
+    v_list = [None] * len(vertices)
+    found = groups == weight_group.index
+    for idx, weight in zip(verts[found].tolist(), weights[found].tolist()):
+        v_list[idx] = weight
     return v_list
 
 
-def merge_weights_to_group(ob, target_group, source_group, blend_mode):
+def blend_weights(target, source, blend_mode, factor=1.0):
+    """ Blend source onto target weight arrays, clamped to 0..1 """
+    if blend_mode == 'ADD':
+        blended = target + source
+    elif blend_mode == 'SUBTRACT':
+        blended = target - source
+    elif blend_mode == 'MULTIPLY':
+        blended = target * source
+    elif blend_mode == 'MAX':
+        blended = np.maximum(target, source)
+    elif blend_mode == 'MIN':
+        blended = np.minimum(target, source)
+    elif blend_mode == 'REPLACE':
+        blended, factor = source, 1.0
+    else:  # MIX
+        blended = source
+    return np.clip(target + (blended - target) * factor, 0.0, 1.0)
+
+
+def group_weight_changes(
+        weights, member, new_weights, touched, remove_zero=False,
+        normalize=False):
+    """
+    (removed, indices, values) arrays that turn a group's current weights
+    and membership into new_weights on the touched vertices; vertices whose
+    weight does not change, and non-members that would join at zero weight,
+    are left out
+    """
+    final = np.where(touched, new_weights, weights)
+    # a zero weight membership still counts as a bone influence on export
+    touched = touched & (member | (final > 0.0))
+    in_group = member | touched
+    removed = np.zeros(0, dtype=np.int64)
+    if normalize and in_group.any():
+        peak = final[in_group].max()
+        if peak > 0.0:
+            final = final / peak
+            touched = in_group
+    if remove_zero:
+        zero = in_group & (final <= 0.0)
+        removed = np.flatnonzero(zero & member)
+        touched = touched & ~zero
+    indices = np.flatnonzero(touched & (~member | (final != weights)))
+    return removed, indices, final[indices]
+
+
+def write_group_changes(weight_group, changes):
+    """ Apply group_weight_changes() output to weight_group """
+    removed, indices, values = changes
+    if len(removed):
+        weight_group.remove(removed.tolist())
+    set_group_weights(weight_group, indices, values)
+
+
+def merge_group_names(ob, mapping):
+    """
+    Create missing mapping targets on ob, return the names of all groups a
+    merge reads: targets first, then sources not also used as targets
+    """
+    vertex_groups = ob.vertex_groups
+    for target_name in mapping:
+        if target_name not in vertex_groups:
+            vertex_groups.new(name=target_name)
+    return merge_read_order(mapping)
+
+
+def merge_read_order(mapping):
+    """ Targets of mapping, then the sources not also used as targets """
+    names = list(mapping)
+    for sources in mapping.values():
+        names.extend(name for name in sources if name not in names)
+    return names
+
+
+def merge_weight_changes(
+        matrix, member, names, mapping, blend_mode, factor=1.0,
+        remove_zero=False, normalize=False):
+    """
+    Array half of merge_weight_groups, safe to run off the main thread:
+    {target name: group_weight_changes()} for columns ordered as names
+    """
+    columns = {name: column for column, name in enumerate(names)}
+    changes = {}
+    for target_name, sources in mapping.items():
+        column = columns[target_name]
+        new_weights = matrix[:, column]
+        touched = np.zeros(len(new_weights), dtype=bool)
+        for source_name in sources:
+            source = columns[source_name]
+            blended = blend_weights(
+                new_weights, matrix[:, source], blend_mode, factor)
+            new_weights = np.where(member[:, source], blended, new_weights)
+            touched |= member[:, source]
+        changes[target_name] = group_weight_changes(
+            matrix[:, column], member[:, column], new_weights, touched,
+            remove_zero, normalize)
+    return changes
+
+
+def write_merge(ob, changes, delete_groups=()):
+    """ Write merge_weight_changes() output, then delete consumed groups """
+    vertex_groups = ob.vertex_groups
+    for target_name, group_changes in changes.items():
+        write_group_changes(vertex_groups[target_name], group_changes)
+    if delete_groups:
+        for name in delete_groups:
+            vertex_groups.remove(vertex_groups[name])
+        # removing groups renumbers the ones after them
+        invalidate_weight_index(ob.data)
+    else:
+        update_weight_index(ob.data, {
+            vertex_groups[target_name].index: group_changes
+            for target_name, group_changes in changes.items()})
+
+
+def merge_weight_groups(
+        ob, mapping, blend_mode, factor=1.0, remove_zero=False,
+        normalize=False, delete_sources=False):
+    """
+    Fold many source groups into their targets in a single pass.
+    mapping is {target name: [source names]}; missing targets are created.
+    Sources are folded in order and always read their weights from before
+    the merge, even if they are also targets of another entry.
+    """
+    names = merge_group_names(ob, mapping)
+    with phase('merge.extract', vertices=len(ob.data.vertices)):
+        matrix, member = get_weight_matrix(
+            ob, [ob.vertex_groups[name] for name in names])
+    with phase('merge.math', groups=len(names)):
+        changes = merge_weight_changes(
+            matrix, member, names, mapping, blend_mode, factor, remove_zero,
+            normalize)
+    with phase('merge.write', vertices=sum(
+            len(removed) + len(indices)
+            for removed, indices, values in changes.values())):
+        write_merge(
+            ob, changes, names[len(mapping):] if delete_sources else ())
+
+
+def merge_weights_to_group(
+        ob, target_group, source_group, blend_mode, factor=1.0,
+        remove_zero=False, normalize=False):
     """ merge source weights into target group using blend_mode """
-    vertices = ob.data.vertices
-    source_weights = get_verts_in_group(vertices, source_group)
-    target_weights = get_verts_in_group(vertices, target_group)
-    new_weights = []
-    for idx, weights in enumerate(zip(source_weights, target_weights)):
-        non_zeros = [w for w in weights if w is not None]
-        if non_zeros:
-            target_group.add([idx], sum(non_zeros), 'REPLACE') # TODO blend_mode
+    merge_weight_groups(
+        ob, {target_group.name: [source_group.name]}, blend_mode, factor,
+        remove_zero, normalize)
+
+
+def match_weight_groups(ob, patterns):
+    """ Names of vertex groups on ob matching any of the fnmatch patterns """
+    return match_names([group.name for group in ob.vertex_groups], patterns)
+
+
+def match_names(names, patterns):
+    """ The names matching any of the fnmatch patterns """
+    patterns = [p.strip() for p in patterns if p.strip()]
+    return [
+        name for name in names
+        if any(fnmatchcase(name, p) for p in patterns)]
+
+
+def rig_meshes(armature, objects):
+    """ Mesh objects deformed by armature """
+    return [
+        ob for ob in objects
+        if ob.type == 'MESH' and ob.find_armature() == armature]
+
+
+def merge_rig_weight_groups(
+        meshes, mapping, blend_mode, factor=1.0, remove_zero=False,
+        normalize=False, delete_sources=False, threads=None):
+    """
+    merge_weight_groups over many meshes, with mapping sources given as
+    fnmatch patterns resolved per mesh. Weights are read and written on the
+    calling (main) thread; the array work runs on a thread pool, where
+    NumPy releases the GIL. Returns the number of meshes merged.
+    """
+    with weight_index_batch():
+        return _merge_rig_weight_groups(
+            meshes, mapping, blend_mode, factor, remove_zero, normalize,
+            delete_sources, threads)
+
+
+def _merge_rig_weight_groups(
+        meshes, mapping, blend_mode, factor, remove_zero, normalize,
+        delete_sources, threads):
+    merged, snapshots = [], []
+    for ob in meshes:
+        mesh_mapping = {}
+        for target_name, patterns in mapping.items():
+            sources = [
+                name for name in match_weight_groups(ob, patterns)
+                if name != target_name]
+            if sources:
+                mesh_mapping[target_name] = sources
+        if not mesh_mapping:
+            continue
+        names = merge_group_names(ob, mesh_mapping)
+        merged.append((ob, names[len(mesh_mapping):]))
+        with phase('merge.extract', vertices=len(ob.data.vertices)):
+            snapshots.append((
+                get_weight_index(ob),
+                [ob.vertex_groups[name].index for name in names],
+                names, mesh_mapping))
+
+    def compute(snapshot):
+        index, group_indices, names, mesh_mapping = snapshot
+        with phase('merge.math', groups=len(names)):
+            matrix, member = index.matrix(group_indices)
+            return merge_weight_changes(
+                matrix, member, names, mesh_mapping, blend_mode, factor,
+                remove_zero, normalize)
+
+    with ThreadPoolExecutor(threads) as pool:
+        results = pool.map(compute, snapshots)
+        for (ob, sources), changes in zip(merged, results):
+            with phase('merge.write', groups=len(changes)):
+                write_merge(ob, changes, sources if delete_sources else ())
+    return len(merged)
+
+
+def deform_group_mask(ob, armature):
+    """ Boolean array over ob's group indices: group is a deforming bone """
+    bones = armature.data.bones
+    return np.array([
+        group.name in bones and bones[group.name].use_deform
+        for group in ob.vertex_groups], dtype=bool)
+
+
+def limit_weight_changes(index, deform, limit=4, normalize=True):
+    """
+    Keep the limit largest deform weights of each vertex in a WeightIndex,
+    optionally rescaling them to sum to 1.0. deform is a boolean array over
+    group indices; other groups are ignored. Returns
+    ({group index: group_weight_changes()-style tuple}, kept count per group)
+    """
+    rows, groups, weights = index.entries()
+    use = deform[groups]
+    rows, groups, weights = rows[use], groups[use], weights[use]
+    order = np.lexsort((-weights, rows))
+    rows, groups, weights = rows[order], groups[order], weights[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    keep = rank < limit
+    new_weights = weights.copy()
+    if normalize:
+        totals = np.bincount(
+            rows[keep], weights[keep], minlength=index.vertex_count)[rows]
+        scaled = keep & (totals > 0.0)
+        new_weights[scaled] = weights[scaled] / totals[scaled]
+    changed = keep & (new_weights != weights)
+    dirty = ~keep | changed
+    by_group = np.argsort(groups[dirty], kind='stable')
+    dirty_groups = groups[dirty][by_group]
+    dirty_rows = rows[dirty][by_group]
+    dirty_keep = keep[dirty][by_group]
+    dirty_weights = new_weights[dirty][by_group]
+    splits = np.flatnonzero(np.diff(dirty_groups)) + 1
+    changes = {}
+    for batch in np.split(np.arange(len(dirty_groups)), splits):
+        if not len(batch):
+            continue
+        kept = dirty_keep[batch]
+        changes[int(dirty_groups[batch[0]])] = (
+            dirty_rows[batch][~kept], dirty_rows[batch][kept],
+            dirty_weights[batch][kept])
+    return changes, np.bincount(groups[keep], minlength=len(deform))
+
+
+def limit_bone_influences(ob, limit=4, normalize=True, prune=True):
+    """
+    Limit every vertex of ob to its limit strongest deform bone weights.
+    Returns the names of deform groups pruned for ending up empty; raises
+    ValueError if no armature deforms ob.
+    """
+    with weight_index_batch():
+        return _limit_bone_influences(ob, limit, normalize, prune)
+
+
+def _limit_bone_influences(ob, limit, normalize, prune):
+    armature = ob.find_armature()
+    if armature is None:
+        raise ValueError("{} is not deformed by an armature".format(ob.name))
+    deform = deform_group_mask(ob, armature)
+    with phase('limit.extract', vertices=len(ob.data.vertices)):
+        index = get_weight_index(ob)
+    with phase('limit.math', weights=len(index.weights)):
+        changes, counts = limit_weight_changes(
+            index, deform, limit, normalize)
+    vertex_groups = ob.vertex_groups
+    with phase('limit.write', groups=len(changes)):
+        for group_index, group_changes in changes.items():
+            write_group_changes(vertex_groups[group_index], group_changes)
+    pruned = []
+    if prune:
+        pruned = [
+            vertex_groups[int(i)].name
+            for i in np.flatnonzero(deform & (counts == 0))]
+        for name in pruned:
+            vertex_groups.remove(vertex_groups[name])
+    if pruned:
+        invalidate_weight_index(ob.data)
+    else:
+        update_weight_index(ob.data, changes)
+    return pruned
+
+
+# Layout version of the .npz files written by WeightSnapshot.save()
+SNAPSHOT_VERSION = 1
+
+
+class WeightSnapshot:
+    """
+    A mesh's vertex weights (WeightIndex arrays and group names) with the
+    bone names, parent indices, rest matrices (row major, m[bone, row,
+    column]) and deform flags of its armature. Saved as .npz and loaded
+    with NumPy alone, so farm workers can import this module outside
+    Blender, run merge_snapshot() or limit_snapshot() and save the result
+    for apply_weight_snapshot().
+    """
+
+    def __init__(
+            self, index, group_names, bone_names=(), parents=None,
+            rest=None, deform=None):
+        self.index = index
+        self.group_names = list(group_names)
+        self.bone_names = list(bone_names)
+        count = len(self.bone_names)
+        self.parents = np.asarray(
+            np.full(count, -1) if parents is None else parents,
+            dtype=np.int64)
+        self.rest = np.asarray(
+            np.tile(np.eye(4), (count, 1, 1)) if rest is None else rest,
+            dtype=np.float64)
+        self.deform = np.asarray(
+            np.ones(count) if deform is None else deform, dtype=bool)
+
+    def save(self, filepath):
+        """
+        Write an uncompressed .npz: cheap to save and load, though np.load
+        still reads each array into memory (archives can't be memory mapped)
+        """
+        np.savez(
+            filepath, version=SNAPSHOT_VERSION, indptr=self.index.indptr,
+            groups=self.index.groups, weights=self.index.weights,
+            group_names=np.array(self.group_names, dtype=str),
+            bone_names=np.array(self.bone_names, dtype=str),
+            parents=self.parents, rest=self.rest, deform=self.deform)
+
+    @classmethod
+    def load(cls, filepath):
+        with np.load(filepath) as data:
+            version = int(data['version'])
+            if version != SNAPSHOT_VERSION:
+                raise ValueError(
+                    "Unsupported weight snapshot version {}".format(version))
+            return cls(
+                WeightIndex.from_arrays(
+                    data['indptr'], data['groups'], data['weights']),
+                data['group_names'].tolist(), data['bone_names'].tolist(),
+                data['parents'], data['rest'], data['deform'])
+
+    def group_indices(self, names):
+        """ Indices of the named groups, adding the missing ones """
+        position = {name: i for i, name in enumerate(self.group_names)}
+        for name in names:
+            if name not in position:
+                position[name] = len(self.group_names)
+                self.group_names.append(name)
+        return [position[name] for name in names]
+
+    def remove_groups(self, names):
+        """ Drop the named groups and their weights """
+        remove = set(names)
+        keep = np.array(
+            [name not in remove for name in self.group_names], dtype=bool)
+        if keep.all():
+            return
+        renumber = (np.cumsum(keep) - 1).astype(np.int32)
+        rows, groups, weights = self.index.entries()
+        use = keep[groups]
+        self.index = WeightIndex.from_entries(
+            rows[use], renumber[groups[use]], weights[use],
+            self.index.vertex_count)
+        self.group_names = [
+            name for name, kept in zip(self.group_names, keep) if kept]
+
+    def deform_mask(self):
+        """ deform_group_mask() from the snapshot's bones """
+        deform = dict(zip(self.bone_names, self.deform.tolist()))
+        return np.array(
+            [deform.get(name, False) for name in self.group_names],
+            dtype=bool)
+
+
+def merge_snapshot(
+        snapshot, mapping, blend_mode, factor=1.0, remove_zero=False,
+        normalize=False, delete_sources=False):
+    """
+    merge_weight_groups() on a WeightSnapshot; mapping sources are fnmatch
+    patterns as in merge_rig_weight_groups(). Returns the merged targets.
+    """
+    mesh_mapping = {}
+    for target_name, patterns in mapping.items():
+        sources = [
+            name for name in match_names(snapshot.group_names, patterns)
+            if name != target_name]
+        if sources:
+            mesh_mapping[target_name] = sources
+    if not mesh_mapping:
+        return []
+    names = merge_read_order(mesh_mapping)
+    indices = snapshot.group_indices(names)
+    with phase('merge.math', groups=len(names)):
+        matrix, member = snapshot.index.matrix(indices)
+        changes = merge_weight_changes(
+            matrix, member, names, mesh_mapping, blend_mode, factor,
+            remove_zero, normalize)
+        snapshot.index = snapshot.index.with_changes({
+            indices[names.index(target_name)]: group_changes
+            for target_name, group_changes in changes.items()})
+    if delete_sources:
+        snapshot.remove_groups(names[len(mesh_mapping):])
+    return list(mesh_mapping)
+
+
+def limit_snapshot(snapshot, limit=4, normalize=True, prune=True):
+    """
+    limit_bone_influences() on a WeightSnapshot, returns the names of the
+    deform groups pruned for ending up empty
+    """
+    deform = snapshot.deform_mask()
+    with phase('limit.math', weights=len(snapshot.index.weights)):
+        changes, counts = limit_weight_changes(
+            snapshot.index, deform, limit, normalize)
+        snapshot.index = snapshot.index.with_changes(changes)
+    pruned = []
+    if prune:
+        pruned = [
+            snapshot.group_names[int(i)]
+            for i in np.flatnonzero(deform & (counts == 0))]
+        snapshot.remove_groups(pruned)
+    return pruned
+
+
+def skeleton_arrays(armature):
+    """ Bone names, parent indices, rest matrices and deform flags """
+    bones = armature.data.bones
+    names = [bone.name for bone in bones]
+    index = {name: i for i, name in enumerate(names)}
+    parents = [
+        index[bone.parent.name] if bone.parent else -1 for bone in bones]
+    rest = np.empty(len(bones) * 16, dtype=np.float64)
+    bones.foreach_get('matrix_local', rest)
+    deform = np.empty(len(bones), dtype=bool)
+    bones.foreach_get('use_deform', deform)
+    return names, parents, rest.reshape(-1, 4, 4).transpose(0, 2, 1), deform
+
+
+def save_weight_snapshot(filepath, ob, armature=None):
+    """
+    Write the weights of mesh object ob and the skeleton of armature
+    (default the one deforming ob) to filepath, returns the snapshot
+    """
+    if armature is None:
+        armature = ob.find_armature()
+    with phase('snapshot.extract', vertices=len(ob.data.vertices)):
+        skeleton = skeleton_arrays(armature) if armature else ()
+        snapshot = WeightSnapshot(
+            get_weight_index(ob), [group.name for group in ob.vertex_groups],
+            *skeleton)
+    with phase('snapshot.save', weights=len(snapshot.index.weights)):
+        snapshot.save(filepath)
+    return snapshot
+
+
+def keys_by_group(keys, size, values):
+    """
+    {group: (vertices, values)} from entry keys of vertex * size + group
+    """
+    groups = keys % size
+    order = np.argsort(groups, kind='stable')
+    groups, keys, values = groups[order], keys[order], values[order]
+    splits = np.flatnonzero(np.diff(groups)) + 1
+    return {
+        int(batch_groups[0]): (batch_keys // size, batch_values)
+        for batch_groups, batch_keys, batch_values in zip(
+            np.split(groups, splits), np.split(keys, splits),
+            np.split(values, splits))
+        if len(batch_groups)}
+
+
+def apply_weight_snapshot(ob, snapshot):
+    """
+    Make the weights of mesh object ob match snapshot, creating missing
+    groups, removing the groups the snapshot lacks and writing only the
+    weights that differ. Returns the number of weights written or removed.
+    """
+    vertex_count = len(ob.data.vertices)
+    if snapshot.index.vertex_count != vertex_count:
+        raise ValueError("Snapshot has {} vertices, {} has {}".format(
+            snapshot.index.vertex_count, ob.name, vertex_count))
+    vertex_groups = ob.vertex_groups
+    size = max(len(snapshot.group_names), 1)
+    with phase('snapshot.extract', vertices=vertex_count):
+        position = {
+            name: i for i, name in enumerate(snapshot.group_names)}
+        to_snapshot = np.array(
+            [position.get(group.name, -1) for group in vertex_groups] + [-1],
+            dtype=np.int64)
+        rows, groups, weights = get_weight_index(ob).entries()
+    with phase('snapshot.math', weights=len(snapshot.index.weights)):
+        mapped = to_snapshot[groups]
+        known = mapped >= 0
+        old_keys = rows[known].astype(np.int64) * size + mapped[known]
+        order = np.argsort(old_keys)
+        old_keys, old_weights = old_keys[order], weights[known][order]
+        new_rows, new_groups, new_weights = snapshot.index.entries()
+        new_keys = new_rows.astype(np.int64) * size + new_groups
+        found = np.zeros(len(new_keys), dtype=bool)
+        if len(old_keys):
+            at = np.searchsorted(old_keys, new_keys).clip(
+                0, len(old_keys) - 1)
+            found = (old_keys[at] == new_keys) & (
+                old_weights[at] == new_weights)
+        removed = old_keys[~np.isin(old_keys, new_keys)]
+        removed = keys_by_group(removed, size, np.zeros(len(removed)))
+        written = keys_by_group(new_keys[~found], size, new_weights[~found])
+    with phase('snapshot.write', groups=len(removed) + len(written)):
+        for name in snapshot.group_names:
+            if name not in vertex_groups:
+                vertex_groups.new(name=name)
+        empty = np.zeros(0, dtype=np.int64)
+        for group in set(removed) | set(written):
+            indices, values = written.get(group, (empty, empty))
+            write_group_changes(
+                vertex_groups[snapshot.group_names[group]],
+                (removed.get(group, (empty,))[0], indices, values))
+        stale = [
+            group for group in vertex_groups if group.name not in position]
+        for group in stale:
+            vertex_groups.remove(group)
+    invalidate_weight_index(ob.data)
+    return sum(
+        len(indices) for indices, values in
+        list(removed.values()) + list(written.values()))
+
+
+BLEND_MODES = [
+    ("ADD", "Add", "Add Source to Active", 0),
+    ("SUBTRACT", "Subtract", "Subtract Source from Active", 1),
+    ("MULTIPLY", "Multiply", "Multiply Active by Source", 2),
+    ("MAX", "Maximum", "Keep the higher of Source and Active", 3),
+    ("MIN", "Minimum", "Keep the lower of Source and Active", 4),
+    ("REPLACE", "Replace", "Replace Active with Source", 5),
+    ("MIX", "Mix", "Mix Active toward Source by Factor", 6),
+    ]
 
 
 def get_weight_groups(self, context):
     return [tuple([g.name] * 3) for g in context.object.vertex_groups]
 
 
-class WeightGroupMerge(bpy.types.Operator):
-    """ Merge Source Weights into Active Weight Group """
-    bl_idname = 'object.vertex_group_merge_weights'
-    bl_label = "Vertex Group Merge Weights"
+# Operators need Blender, everything above only NumPy
+if bpy is not None:
+    class WeightBlendOptions:
+        """ Blend settings shared by the merge operators """
+        blend_mode = bpy.props.EnumProperty(
+            items=BLEND_MODES, name='Blend Mode')
+        factor = bpy.props.FloatProperty(
+            name='Factor', default=1.0, min=0.0, max=1.0,
+            description="Influence of the blended result on the Active group")
+        remove_zero = bpy.props.BoolProperty(
+            name='Remove Zero', default=False,
+            description="Remove vertices left with zero weight from the group")
+        normalize = bpy.props.BoolProperty(
+            name='Normalize', default=False,
+            description="Scale the result so its highest weight is 1.0")
 
-    source_group = bpy.props.EnumProperty(
-        items=get_weight_groups, name='Blend From Group')
-    blend_mode = bpy.props.EnumProperty(
-        items=[("ADD", "Add", "Add Source to Active", 0)],
-        name='Blend Mode')
-    
-    @classmethod
-    def poll(cls, context):
-        return (
-            context.object and
-            context.object.type == 'MESH' and
-            context.object.vertex_groups.active)
-    
-    def invoke(self, context, event):
-        context.window_manager.invoke_props_dialog(self)
-        return {'RUNNING_MODAL'}
-
-    def execute(self, context):
-        ob = context.object
-        target_group = ob.vertex_groups.active
-        source_group = ob.vertex_groups[self.source_group]
-        merge_weights_to_group(ob, target_group, source_group, self.blend_mode)
-        return {'FINISHED'}
+    class WeightGroupMerge(WeightBlendOptions, bpy.types.Operator):
+        """ Merge Source Weights into Active Weight Group """
+        bl_idname = 'object.vertex_group_merge_weights'
+        bl_label = "Vertex Group Merge Weights"
+
+        source_group = bpy.props.EnumProperty(
+            items=get_weight_groups, name='Blend From Group')
+
+        @classmethod
+        def poll(cls, context):
+            return (
+                context.object and
+                context.object.type == 'MESH' and
+                context.object.vertex_groups.active)
+
+        def invoke(self, context, event):
+            context.window_manager.invoke_props_dialog(self)
+            return {'RUNNING_MODAL'}
+
+        @profiled
+        @batched
+        def execute(self, context):
+            ob = context.object
+            target_group = ob.vertex_groups.active
+            source_group = ob.vertex_groups[self.source_group]
+            merge_weights_to_group(
+                ob, target_group, source_group, self.blend_mode, self.factor,
+                self.remove_zero, self.normalize)
+            return {'FINISHED'}
+
+    class WeightGroupMergeMany(WeightBlendOptions, bpy.types.Operator):
+        """ Merge Several Source Weight Groups into the Active Weight Group """
+        bl_idname = 'object.vertex_group_merge_many'
+        bl_label = "Vertex Group Merge Many"
+
+        source_groups = bpy.props.StringProperty(
+            name='Blend From Groups',
+            description=(
+                "Comma separated group names or patterns, e.g. f_index*"))
+        delete_sources = bpy.props.BoolProperty(
+            name='Delete Sources', default=False,
+            description="Remove the source groups once they are merged")
+
+        @classmethod
+        def poll(cls, context):
+            return WeightGroupMerge.poll(context)
+
+        def invoke(self, context, event):
+            context.window_manager.invoke_props_dialog(self)
+            return {'RUNNING_MODAL'}
+
+        @profiled
+        @batched
+        def execute(self, context):
+            ob = context.object
+            target_name = ob.vertex_groups.active.name
+            sources = [
+                name for name in match_weight_groups(
+                    ob, self.source_groups.split(','))
+                if name != target_name]
+            if not sources:
+                self.report({'WARNING'}, "No vertex groups match the sources")
+                return {'CANCELLED'}
+            merge_weight_groups(
+                ob, {target_name: sources}, self.blend_mode, self.factor,
+                self.remove_zero, self.normalize, self.delete_sources)
+            return {'FINISHED'}
+
+    class WeightGroupMergeRig(WeightBlendOptions, bpy.types.Operator):
+        """ Merge Weight Groups on Every Mesh Deformed by an Armature """
+        bl_idname = 'object.vertex_group_merge_rig'
+        bl_label = "Vertex Group Merge on Rig Meshes"
+
+        armature = bpy.props.StringProperty(name='Armature')
+        target_group = bpy.props.StringProperty(name='Blend Into Group')
+        source_groups = bpy.props.StringProperty(
+            name='Blend From Groups',
+            description=(
+                "Comma separated group names or patterns, e.g. f_index*"))
+        delete_sources = bpy.props.BoolProperty(
+            name='Delete Sources', default=False,
+            description="Remove the source groups once they are merged")
+
+        @classmethod
+        def poll(cls, context):
+            return (
+                context.object and context.object.type in ('MESH', 'ARMATURE'))
+
+        def invoke(self, context, event):
+            ob = context.object
+            armature = ob if ob.type == 'ARMATURE' else ob.find_armature()
+            if armature:
+                self.armature = armature.name
+            if ob.type == 'MESH' and ob.vertex_groups.active:
+                self.target_group = ob.vertex_groups.active.name
+            context.window_manager.invoke_props_dialog(self)
+            return {'RUNNING_MODAL'}
+
+        def draw(self, context):
+            layout = self.layout
+            layout.prop_search(self, 'armature', context.scene, 'objects')
+            for prop in (
+                    'target_group', 'source_groups', 'blend_mode', 'factor',
+                    'remove_zero', 'normalize', 'delete_sources'):
+                layout.prop(self, prop)
+
+        @profiled
+        @batched
+        def execute(self, context):
+            armature = context.scene.objects.get(self.armature)
+            if not armature or armature.type != 'ARMATURE' or not (
+                    self.target_group):
+                self.report({'ERROR'}, "Need an armature and a target group")
+                return {'CANCELLED'}
+            meshes = rig_meshes(armature, context.scene.objects)
+            count = merge_rig_weight_groups(
+                meshes, {self.target_group: self.source_groups.split(',')},
+                self.blend_mode, self.factor, self.remove_zero, self.normalize,
+                self.delete_sources)
+            self.report({'INFO'}, "Merged weights on {} of {} meshes".format(
+                count, len(meshes)))
+            return {'FINISHED'}
+
+    class WeightLimitInfluences(bpy.types.Operator):
+        """ Keep Only the Strongest Deform Bone Weights on Each Vertex """
+        bl_idname = 'object.vertex_group_limit_influences'
+        bl_label = "Limit Bone Influences"
+
+        limit = bpy.props.IntProperty(
+            name='Limit', default=4, min=1, max=8,
+            description="Bone weights kept per vertex, Unity uses 1, 2 or 4")
+        normalize = bpy.props.BoolProperty(
+            name='Normalize', default=True,
+            description="Make the kept weights of each vertex sum to 1.0")
+        prune = bpy.props.BoolProperty(
+            name='Prune Empty', default=True,
+            description="Remove deform groups left without any vertices")
+
+        @classmethod
+        def poll(cls, context):
+            return (
+                context.object and
+                context.object.type == 'MESH' and
+                context.object.find_armature())
+
+        def invoke(self, context, event):
+            context.window_manager.invoke_props_dialog(self)
+            return {'RUNNING_MODAL'}
+
+        @profiled
+        @batched
+        def execute(self, context):
+            try:
+                pruned = limit_bone_influences(
+                    context.object, self.limit, self.normalize, self.prune)
+            except ValueError as error:
+                self.report({'ERROR'}, str(error))
+                return {'CANCELLED'}
+            if pruned:
+                self.report({'INFO'}, "Removed empty groups: {}".format(
+                    ', '.join(pruned)))
+            return {'FINISHED'}
+
+    class WeightSnapshotExport(bpy.types.Operator):
+        """ Save Weights and Skeleton to a .npz for Offline Processing """
+        bl_idname = 'object.vertex_weights_export'
+        bl_label = "Export Weight Snapshot"
+
+        filepath = bpy.props.StringProperty(subtype='FILE_PATH')
+
+        @classmethod
+        def poll(cls, context):
+            return context.object and context.object.type == 'MESH'
+
+        def invoke(self, context, event):
+            if not self.filepath:
+                self.filepath = (
+                    bpy.path.clean_name(context.object.name) + '.npz')
+            context.window_manager.fileselect_add(self)
+            return {'RUNNING_MODAL'}
+
+        @profiled
+        @batched
+        def execute(self, context):
+            snapshot = save_weight_snapshot(
+                bpy.path.abspath(self.filepath), context.object)
+            self.report({'INFO'}, "Saved {} weights, {} bones".format(
+                len(snapshot.index.weights), len(snapshot.bone_names)))
+            return {'FINISHED'}
+
+    class WeightSnapshotImport(bpy.types.Operator):
+        """ Replace the Weights with a Processed Weight Snapshot """
+        bl_idname = 'object.vertex_weights_import'
+        bl_label = "Import Weight Snapshot"
+        bl_options = {'REGISTER', 'UNDO'}
+
+        filepath = bpy.props.StringProperty(subtype='FILE_PATH')
+        filter_glob = bpy.props.StringProperty(
+            default='*.npz', options={'HIDDEN'})
+
+        @classmethod
+        def poll(cls, context):
+            return WeightSnapshotExport.poll(context)
+
+        def invoke(self, context, event):
+            context.window_manager.fileselect_add(self)
+            return {'RUNNING_MODAL'}
+
+        @profiled
+        @batched
+        def execute(self, context):
+            try:
+                snapshot = WeightSnapshot.load(
+                    bpy.path.abspath(self.filepath))
+                count = apply_weight_snapshot(context.object, snapshot)
+            except (OSError, KeyError, ValueError) as error:
+                self.report({'ERROR'}, str(error))
+                return {'CANCELLED'}
+            self.report({'INFO'}, "Updated {} weights".format(count))
+            return {'FINISHED'}
 
 
 def draw_func(self, context):
@@ -108,10 +1079,25 @@ def draw_func(self, context):
     col = self.layout.column()
     col.operator(
         WeightGroupMerge.bl_idname, text="Merge Weights")
+    col.operator(
+        WeightGroupMergeMany.bl_idname, text="Merge Many Weights")
+    col.operator(
+        WeightGroupMergeRig.bl_idname, text="Merge Weights on Rig")
+    col.operator(
+        WeightLimitInfluences.bl_idname, text="Limit Bone Influences")
+    col.operator(
+        WeightSnapshotExport.bl_idname, text="Export Weight Snapshot")
+    col.operator(
+        WeightSnapshotImport.bl_idname, text="Import Weight Snapshot")
 
 
 def register():
     bpy.utils.register_class(WeightGroupMerge)
+    bpy.utils.register_class(WeightGroupMergeMany)
+    bpy.utils.register_class(WeightGroupMergeRig)
+    bpy.utils.register_class(WeightLimitInfluences)
+    bpy.utils.register_class(WeightSnapshotExport)
+    bpy.utils.register_class(WeightSnapshotImport)
     bpy.types.VIEW3D_PT_tools_weightpaint.append(draw_func)
     bpy.types.VIEW3D_PT_tools_meshweight.append(draw_func)
 
@@ -119,6 +1105,11 @@ def register():
 def unregister():
     bpy.types.VIEW3D_PT_tools_meshweight.remove(draw_func)
     bpy.types.VIEW3D_PT_tools_weightpaint.remove(draw_func)
+    bpy.utils.unregister_class(WeightSnapshotImport)
+    bpy.utils.unregister_class(WeightSnapshotExport)
+    bpy.utils.unregister_class(WeightLimitInfluences)
+    bpy.utils.unregister_class(WeightGroupMergeRig)
+    bpy.utils.unregister_class(WeightGroupMergeMany)
     bpy.utils.unregister_class(WeightGroupMerge)
 
 if __name__ == "__main__":